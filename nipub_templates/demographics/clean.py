@@ -1,18 +1,53 @@
+import json
+import typing
+from itertools import islice
+from pathlib import Path
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils.jsonl import read_jsonl
+
+from .schemas import GroupImaging
+
+META_KEYS = ["pmcid", "rank", "start_char", "end_char", "id"]
+
+# Arrow types of record-level meta keys
+META_TYPES = {
+    "pmcid": pa.int64(),
+    "rank": pa.int64(),
+    "start_char": pa.int64(),
+    "end_char": pa.int64(),
+    "id": pa.string(),
+}
 
 
 def clean_predictions(predictions):
-    # Clean known issues with GPT demographics predictions
+    """ Clean known issues with GPT demographics predictions
+
+    Args:
+        predictions: list of predictions, or path to a JSON list or a JSONL
+            stream
+    """
+    if isinstance(predictions, (str, Path)):
+        if Path(predictions).suffix == ".json":
+            with open(predictions) as f:
+                predictions = json.load(f)
+        else:
+            predictions = read_jsonl(predictions)
+
+    # Only records with groups are kept in memory
     predictions = [p for p in predictions if "groups" in p]
 
-    meta_keys = ["pmcid", "rank", "start_char", "end_char", "id"]
-    meta_keys = [k for k in meta_keys if k in predictions[0]]
+    # Meta keys present in any record (not only the first)
+    meta_keys = [k for k in META_KEYS if any(k in p for p in predictions)]
     
     # Convert JSON to DataFrame
     predictions = pd.json_normalize(
         predictions, record_path=["groups"],
-        meta=meta_keys
+        meta=meta_keys, errors="ignore"
         )
     
     predictions.columns = predictions.columns.str.replace(' ', '_')
@@ -47,4 +82,160 @@ def clean_predictions(predictions):
         - predictions.loc[ix_female_miss, "male_count"]
     )
 
-    return predictions
\ No newline at end of file
+    return predictions
+
+def _arrow_type(field):
+    annotation = field.annotation
+    if typing.get_origin(annotation) is typing.Union:
+        annotation = next(
+            a for a in typing.get_args(annotation) if a is not type(None))
+    # Int fields hold fractional values too (e.g. a median age of 34.5),
+    # which clean_predictions keeps
+    if annotation in (int, float):
+        return pa.float64()
+    extra = field.json_schema_extra or {}
+    if "enum" in extra:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def group_schema(group_model=GroupImaging, meta_keys=META_KEYS):
+    """ Arrow schema of flattened groups: one typed column per field of the
+    group model (enum fields are dictionary encoded), then meta keys """
+    fields = [
+        pa.field(name, _arrow_type(field))
+        for name, field in group_model.model_fields.items()
+    ]
+    fields += [pa.field(k, META_TYPES.get(k, pa.string())) for k in meta_keys]
+    return pa.schema(fields)
+
+
+def coerce_array(values, type):
+    """ Coerce raw JSON values to a typed array; invalid values become null """
+    values = pd.Series(values, dtype=object)
+    if pa.types.is_integer(type) or pa.types.is_floating(type):
+        numbers = pd.to_numeric(values, errors="coerce").astype(float)
+        if pa.types.is_integer(type):
+            # Non-integral values are invalid for int fields
+            numbers[numbers % 1 != 0] = np.nan
+        return pa.array(numbers, type=type, from_pandas=True)
+    strings = values.where(values.isna(), values.astype(str))
+    array = pa.array(strings, type=pa.string(), from_pandas=True)
+    if pa.types.is_dictionary(type):
+        array = array.dictionary_encode()
+    return array
+
+
+def _flatten(records, schema):
+    """ Record batch of groups from a list of prediction records """
+    columns = {name: [] for name in schema.names}
+    for record in records:
+        # Runs may contain empty ([]) records for failed extractions
+        if not isinstance(record, dict):
+            continue
+        groups = record.get("groups")
+        if not isinstance(groups, list):
+            continue
+        for group in groups:
+            if not isinstance(group, dict):
+                continue
+            group = {k.replace(" ", "_"): v for k, v in group.items()}
+            for name in columns:
+                source = record if name in META_KEYS else group
+                columns[name].append(source.get(name))
+
+    arrays = [coerce_array(columns[f.name], f.type) for f in schema]
+    # Unlike group fields, invalid pmcids are errors, not nulls
+    pmcids = arrays[schema.get_field_index("pmcid")].to_pylist()
+    invalid = [raw for raw, pmcid in zip(columns["pmcid"], pmcids)
+               if pmcid is None and not pd.isna(raw)]
+    if invalid:
+        raise ValueError(f"Non-numeric pmcids: {invalid[:5]}")
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _impute(batch):
+    """ Same rules as clean_predictions, on Arrow arrays """
+    group_name = batch.column("group_name")
+    if pa.types.is_dictionary(group_name.type):
+        group_name = group_name.cast(pa.string())
+    group_name = pc.fill_null(group_name, "healthy")
+
+    # Drop rows where count is NA
+    keep = pc.is_valid(batch.column("count"))
+    batch = batch.filter(keep)
+    group_name = group_name.filter(keep)
+
+    # Set group_name to healthy if no diagnosis
+    no_diagnosis = pc.is_null(batch.column("diagnosis"))
+    group_name = pc.if_else(no_diagnosis, "healthy", group_name)
+
+    # If one of the sex counts is missing, substract the other from count
+    count = batch.column("count")
+    male, female = batch.column("male_count"), batch.column("female_count")
+    male = pc.if_else(
+        pc.and_(pc.is_null(male), pc.is_valid(female)),
+        pc.subtract(count, female), male)
+    female = pc.if_else(
+        pc.and_(pc.is_null(female), pc.is_valid(male)),
+        pc.subtract(count, male), female)
+
+    columns = {
+        "group_name": group_name.dictionary_encode()
+        if pa.types.is_dictionary(batch.schema.field("group_name").type)
+        else group_name,
+        "male_count": male,
+        "female_count": female,
+    }
+    arrays = [columns.get(name, batch.column(name)) for name in batch.schema.names]
+    return pa.RecordBatch.from_arrays(arrays, schema=batch.schema)
+
+
+def iter_clean_batches(predictions, batch_size=10_000, group_model=GroupImaging):
+    """ Stream cleaned, flattened groups as Arrow record batches
+
+    Only `batch_size` prediction records are held in memory at a time.
+
+    Args:
+        predictions: path to a JSONL (or JSON list) file, or an iterable of
+            prediction records
+        batch_size: prediction records per batch
+        group_model: pydantic model of a group, defining column types
+    """
+    if isinstance(predictions, (str, Path)):
+        if Path(predictions).suffix == ".json":
+            # A JSON list can only be read whole
+            with open(predictions) as f:
+                predictions = json.load(f)
+        else:
+            predictions = read_jsonl(predictions)
+
+    schema = group_schema(group_model)
+    predictions = iter(predictions)
+    while True:
+        records = list(islice(predictions, batch_size))
+        if not records:
+            break
+        batch = _flatten(records, schema)
+        if batch.num_rows:
+            yield _impute(batch)
+
+
+def clean_predictions_to_parquet(predictions, output_path, batch_size=10_000,
+                                 group_model=GroupImaging):
+    """ Clean predictions into a parquet file, one batch at a time
+
+    Args:
+        predictions: path to a JSONL (or JSON list) file, or an iterable of
+            prediction records
+        output_path: parquet file to write
+    Returns:
+        number of groups written
+    """
+    n_rows = 0
+    schema = group_schema(group_model)
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in iter_clean_batches(predictions, batch_size, group_model):
+            writer.write_batch(batch)
+            n_rows += batch.num_rows
+    return n_rows
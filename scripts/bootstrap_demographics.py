@@ -0,0 +1,100 @@
+""" Bootstrap CIs of demographics evaluation metrics for every run
+
+Papers are resampled with the same weights for all runs, so CIs are
+comparable across runs, and replicates are paired.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Change directory for importing
+import sys
+sys.path.append('../')
+from utils.bootstrap import (
+    bootstrap_table, bootstrap_weights, group_count_matches,
+    percentage_errors, score_sums)
+from utils.filters import filter_groups
+from utils.prediction_store import (
+    PARTITION_COLUMNS, PredictionStore, parse_run_name)
+
+output_dir = Path('../outputs/demographics')
+results_dir = output_dir / 'extractions'
+
+# Cleaned predictions of all runs (see migrate_predictions.py)
+store = PredictionStore(output_dir / 'predictions')
+
+# Matched diagnosis pairs (see evaluate_diagnosis_bertscore.py)
+matches_path = output_dir / 'bertscore_matches.csv'
+
+RUN_COLUMNS = [c for c in PARTITION_COLUMNS if c != 'stage']
+
+n_boot = 2000
+seed = 0
+
+
+def load_annotations():
+    combined_annotations = pd.read_csv('../annotations/combined_pd.csv')
+    combined_annotations.columns = combined_annotations.columns.str.replace(' ', '_')
+    return combined_annotations.sort_values('pmcid')
+
+
+def _run_key(values):
+    """ Hashable run metadata, with missing values as None """
+    return tuple(None if pd.isna(v) else v for v in values)
+
+
+def load_matches(path, matching='greedy'):
+    """ {run key: matched BERTScore pairs} """
+    if not Path(path).exists():
+        return {}
+    matches = pd.read_csv(path)
+    matches = matches[matches.matching == matching]
+    return {
+        _run_key(parse_run_name(run_name)[c] for c in RUN_COLUMNS): run_matches
+        for run_name, run_matches in matches.groupby('run_name')
+    }
+
+
+def bootstrap_runs(annotations, predictions, matches=None, n_boot=n_boot,
+                   seed=seed):
+    """ Estimates and CIs of avg_mean_percentage_error, group count accuracy
+    and BERTScore F1 (if matches are given) of each run """
+    matches = matches or {}
+    papers = np.union1d(
+        annotations.pmcid.dropna().astype(int),
+        predictions.pmcid.dropna().astype(int))
+    weights = bootstrap_weights(len(papers), n_boot, seed)
+
+    tables = []
+    for values, predictions in predictions.groupby(RUN_COLUMNS, dropna=False):
+        key = _run_key(values)
+        predictions = filter_groups(predictions.drop(columns=PARTITION_COLUMNS))
+        run_annotations = annotations[
+            annotations.pmcid.isin(predictions.pmcid.unique())]
+
+        metrics = {
+            ('group_count_accuracy', 'n_groups'): group_count_matches(
+                run_annotations, predictions, papers),
+        }
+        sums, counts, columns = percentage_errors(
+            run_annotations, predictions, papers)
+        for i, column in enumerate(columns):
+            metrics[('avg_mean_percentage_error', column)] = \
+                sums[:, i], counts[:, i]
+        if key in matches:
+            metrics[('bertscore_f1', 'diagnosis')] = score_sums(
+                matches[key], papers)
+
+        run = dict(zip(RUN_COLUMNS, key))
+        run['model_name'] = run.pop('model')
+        tables.append(bootstrap_table(metrics, weights).assign(**run))
+
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    predictions = store.read(
+        stage='clean', strategy=['chunked', 'full'], categorical=False)
+    results = bootstrap_runs(
+        load_annotations(), predictions, load_matches(matches_path))
+    results.to_csv(results_dir / 'bootstrap_results.csv', index=False)
@@ -1,9 +1,15 @@
+import sys
 from pathlib import Path
 import pandas as pd
 from bert_score import BERTScorer
 from itertools import product
 from tqdm import tqdm
 
+sys.path.append('../')
+from utils.bertscore import CachedBERTScorer, EmbeddingCache, PairScoreCache
+from utils.filters import filter_groups
+from utils.matching import match, pair_frame
+
 # Load annotations
 combined_annotations = pd.read_csv('../annotations/combined_pd.csv')
 
@@ -17,6 +23,11 @@ output_dir = Path('../outputs/demographics')
 results_dir = output_dir / 'extractions'
 
 scorer = BERTScorer(lang='en-sci', rescale_with_baseline=True)
+# Each unique diagnosis string is embedded once, and each unique pair is
+# scored once, across all files and evaluation runs
+cached_scorer = CachedBERTScorer(
+    scorer, cache=EmbeddingCache('../outputs/bertscore_embeddings.sqlite'),
+    pair_cache=PairScoreCache('../outputs/bertscore_pairs.sqlite'))
 
 ## Matching score approach
 ## First only look at imaging samples and groups with diaganosis
@@ -25,71 +36,34 @@ scorer = BERTScorer(lang='en-sci', rescale_with_baseline=True)
 ## By taking the maximum similarity for first group and then removing that group
 ## And then taking the maximum similarity for the second group
 
-def _filter_imaging_sample(x):
-    # If multiple vaules for imaging_sample, take those != no
-    if x.imaging_sample.unique().size > 1:
-        return x[x.imaging_sample != 'no']
-    return x
-
-
-def _evaluate(annotations, predictions, agg=True):
-    " Evaluate the predictions against the annotations  for the diagnosis column"
-        # Subset to only include mri participant groups
-    if 'imaging_sample' in predictions.columns:
-        predictions = predictions.groupby('pmcid')[predictions.columns].apply(
-            lambda x: _filter_imaging_sample(x)
-        ).reset_index(drop=True)
-
-    if 'assessment_type' in predictions.columns:
-        predictions = predictions[predictions.assessment_type != 'behavioral']
-
+def _subset(annotations, predictions):
+    """ Patient groups of imaging samples, for pmcids with annotations """
+    # Subset to only include mri participant groups
+    predictions = filter_groups(predictions)
 
     # Subset to only include patients
     annotations = annotations[annotations.group_name == 'patients']
     predictions = predictions[predictions.pmcid.isin(annotations.pmcid.unique())]
     predictions = predictions[predictions.group_name == 'patients']
+    return annotations, predictions
+
 
-    all_scores = []
-
-    for pmcid, preds in predictions.groupby('pmcid'):
-        annots = annotations[annotations.pmcid == pmcid]
-
-        # Get bert scores for all combinations of the preds/annotations
-        scores = []
-        for cand_ix, ref_ix in list(product(range(preds.shape[0]), range(annots.shape[0]))):
-            if pd.isna(preds.iloc[cand_ix].diagnosis) or pd.isna(annots.iloc[ref_ix].diagnosis):
-                scores.append((cand_ix, ref_ix, 0, 0, -1))
-                continue
-            # Get the similarity score
-            score = scorer.score(
-                [preds.iloc[cand_ix].diagnosis],
-                [annots.iloc[ref_ix].diagnosis]
-            )
-            scores.append((cand_ix, ref_ix) + score)
-
-        # Starting with the highest f1 score, take the matched pairs
-        # If that annotation or prediction group has not been matched
-        cand_matched = []
-        ref_matched = []
-        for score in sorted(scores, key=lambda x: x[-1], reverse=True):
-            cand_ix, ref_ix, p, r, f1 = score
-            if f1 == -1:
-                p, r, f1 = (pd.NA, pd.NA, pd.NA)  # If f1 is -1, set to NA to indicate missing value
-            if cand_ix not in cand_matched and ref_ix not in ref_matched:
-                cand_matched.append(cand_ix)
-                ref_matched.append(ref_ix)
-                all_scores.append({
-                    'pmcid': pmcid,
-                    'prediction': preds.iloc[cand_ix].diagnosis,
-                    'annotation': annots.iloc[ref_ix].diagnosis,
-                    'p': p,
-                    'r': r,
-                    'f1': f1
-                })
+def _pairs(annotations, predictions):
+    """ All (prediction, annotation) diagnosis pairs compared within a pmcid """
+    pairs = pair_frame(annotations, predictions).dropna(
+        subset=['prediction', 'annotation'])
+    return set(zip(pairs.prediction, pairs.annotation))
+
+
+def _evaluate(annotations, predictions, pair_scores, method='greedy', agg=True):
+    """ Evaluate the predictions against the annotations for the diagnosis
+    column, using precomputed {(prediction, annotation): (p, r, f1)} scores.
+    Groups are matched greedily (highest f1 first) or optimally. """
+    all_scores = match(annotations, predictions, pair_scores, method=method)
 
     if agg:
-        all_scores = pd.DataFrame(all_scores)
-        all_scores = all_scores.agg({
+        all_scores = pd.DataFrame(all_scores, columns=['p', 'r', 'f1'])
+        all_scores = all_scores.astype(float).agg({
             'p': 'mean',
             'r': 'mean',
             'f1': 'mean'
@@ -99,14 +73,32 @@ def _evaluate(annotations, predictions, agg=True):
 
 
 all_files = list(results_dir.glob('chunked_*zeroshot*_clean.csv')) + list(results_dir.glob('full_*zeroshot*_clean.csv'))
-eval_results = []
+# Collect all pairs across files, then score them in large batches
+subsets = {}
+all_pairs = set()
 for f in tqdm(all_files):
     predictions = pd.read_csv(f)
     predictions.columns = predictions.columns.str.replace(' ', '_')
+    subsets[f] = _subset(combined_annotations, predictions)
+    all_pairs |= _pairs(*subsets[f])
+
+pair_scores = cached_scorer.score_pairs(sorted(all_pairs))
+print(f"Pair cache hit rate: {cached_scorer.hit_rate():.1%} "
+      f"({cached_scorer.stats['misses']} new pairs scored)")
+
+eval_results = []
+all_matches = []
+for f, method in product(all_files, ['greedy', 'optimal']):
+    stats = _evaluate(*subsets[f], pair_scores, method=method)
 
-    stats = _evaluate(combined_annotations, predictions)
+    # Matched pairs, for bootstrap CIs (see bootstrap_demographics.py)
+    matches = pd.DataFrame(
+        _evaluate(*subsets[f], pair_scores, method=method, agg=False),
+        columns=['pmcid', 'prediction', 'annotation', 'p', 'r', 'f1'])
+    all_matches.append(matches.assign(run_name=f.stem, matching=method))
 
     stats = pd.DataFrame(stats).reset_index()
+    stats['matching'] = method
 
     # Add metadata to pd dataframe
     fsplit = f.stem.split('_')
@@ -127,4 +119,5 @@ for f in tqdm(all_files):
 eval_results = pd.concat(eval_results)
 eval_results = pd.DataFrame(eval_results)
 eval_results.rename(columns={'index': 'metric', '0': 'score'}, inplace=True)
-eval_results.to_csv(output_dir / 'bertscore_results.csv', index=False)
\ No newline at end of file
+eval_results.to_csv(output_dir / 'bertscore_results.csv', index=False)
+pd.concat(all_matches).to_csv(output_dir / 'bertscore_matches.csv', index=False)
\ No newline at end of file
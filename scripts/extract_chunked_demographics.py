@@ -1,7 +1,6 @@
 import pandas as pd
 import os
 from pathlib import Path
-from publang.pipelines import search_extract
 from labelrepo.projects.participant_demographics import \
         get_participant_demographics
 from labelrepo import database
@@ -13,6 +12,9 @@ sys.path.append('../')
 
 from nipub_templates.demographics.prompts import ZERO_SHOT_MULTI_GROUP_FC, FEW_SHOT_FC
 from nipub_templates.demographics.clean import clean_predictions
+from utils.cache import ExtractionCache
+from utils.embedding_store import EmbeddingStore
+from utils.retrieval import search_extract
 
 # Load original annotations
 combined_annotations = pd.read_csv('../annotations/combined_pd.csv')
@@ -30,6 +32,13 @@ output_dir = Path('../outputs/demographicsextractions')
 
 # Set up OpenAI clients
 embed_model = 'text-embedding-ada-002'
+
+# Embeddings shared across chunking configs, keyed by chunk text and model
+store = EmbeddingStore(Path('../outputs/embeddings') / embed_model)
+
+# Responses are cached across runs, keyed by model, prompt and schema
+cache = ExtractionCache('../outputs/llm_cache.sqlite')
+
 openai_client = OpenAI(api_key=os.getenv('MYOPENAI_API_KEY'))
 fireworks_client = OpenAI(api_key=os.getenv('FIREWORKS_API_KEY'), 
                           base_url='https://api.fireworks.ai/inference/v1')
@@ -44,24 +53,21 @@ def _run(extraction_model, extraction_client, min_chars, max_chars,
     prepend += '_'
     short_model_name = extraction_model.split('/')[-1]
 
-    embeddings_path = output_dir / \
-        f'chunked_embeddings_minc-{min_chars}_maxc-{max_chars}.parquet'
-
     name = f"chunked_{prepend}{short_model_name}_minc-{min_chars}_maxc-{max_chars}"
-    predictions_path = output_dir / f'{name}.json'
+    predictions_path = output_dir / f'{name}.jsonl'
     clean_predictions_path = output_dir / f'{name}_clean.csv'
 
-    # Extract
-    predictions = search_extract(
+    # Retrieve top chunk per article, and extract (resumes if interrupted)
+    search_extract(
         articles=docs, output_path=predictions_path,
         min_chars=min_chars, max_chars=max_chars,
-        embeds_path=embeddings_path, extraction_model=extraction_model,
+        store=store, extraction_model=extraction_model,
         embed_model=embed_model, embed_client=openai_client,
-        extraction_client=extraction_client,
+        extraction_client=extraction_client, cache=cache,
         **extract_kwargs
     )
 
-    clean_predictions(predictions).to_csv(
+    clean_predictions(predictions_path).to_csv(
         clean_predictions_path, index=False
     )
 
@@ -79,4 +85,9 @@ models = [
 # Split body into large sections (by setting min_chars to high number)
 for model_name, client in models:
     _run(model_name, client, 40, 4000, prepend='demographics-fewshot',
-         **FEW_SHOT_FC, num_workers=10)
\ No newline at end of file
+         **FEW_SHOT_FC)
+
+# Pack the top 10 chunks of each article into one call of up to 3000 tokens
+# for model_name, client in models:
+#     _run(model_name, client, 40, 4000, prepend='demographics-fewshot-packed',
+#          k=10, token_budget=3000, **FEW_SHOT_FC)
\ No newline at end of file
@@ -2,47 +2,69 @@ import pandas as pd
 import os
 from pathlib import Path
 from nipub_templates.demographics.prompts import ZERO_SHOT_MULTI_GROUP_FC
-from nipub_templates.demographics.clean import clean_predictions
-from publang.pipelines import search_extract
+from nipub_templates.demographics.clean import clean_predictions_to_parquet
+from utils.cache import ExtractionCache
+from utils.embedding_store import EmbeddingStore
+from utils.batch import batch_extract
+from utils.retrieval import CHUNK_META, retrieve_chunks, search_extract
 from openai import OpenAI
 
 
 inputs = pd.read_csv('/data/alejandro/projects/ns-pond/source/mega-ni-dataset/pubget_searches/fmri_journal/query_875641cf4cbc22f32027447cd62fca27/subset_allArticles_extractedData/text.csv')
-
+docs = inputs.rename(columns={'body': 'text'})[['pmcid', 'text']].dropna()
+docs = docs.to_dict(orient='records')
 
 output_dir = Path('../outputs/demographicsextractions')
 
 # Set up OpenAI clients
+embed_model = 'text-embedding-ada-002'
+
+# Embeddings shared across chunking configs, keyed by chunk text and model
+store = EmbeddingStore(Path('../outputs/embeddings') / embed_model)
+
+# Responses are cached across runs, keyed by model, prompt and schema
+cache = ExtractionCache('../outputs/llm_cache.sqlite')
+
 openai_client = OpenAI(api_key=os.getenv('MYOPENAI_API_KEY'))
 fireworks_client = OpenAI(api_key=os.getenv('FIREWORKS_API_KEY'), 
                           base_url='https://api.fireworks.ai/inference/v1')
 
 
 def _run(extraction_model, extraction_client, min_chars, max_chars,
-         prepend='', **extract_kwargs):
+         prepend='', batch=False, **extract_kwargs):
     prepend += '_'
     short_model_name = extraction_model.split('/')[-1]
 
-    embeddings_path = output_dir / \
-        f'all_embeddings_minc-{min_chars}_maxc-{max_chars}.parquet'
-
     name = f"all_{prepend}{short_model_name}_minc-{min_chars}_maxc-{max_chars}"
-    predictions_path = output_dir / f'{name}.json'
-    clean_predictions_path = output_dir / f'{name}_clean.csv'
+    predictions_path = output_dir / f'{name}.jsonl'
+    clean_predictions_path = output_dir / f'{name}_clean.parquet'
 
-    # Extract
-    predictions = search_extract(
-        articles=docs, output_path=predictions_path,
-        min_chars=min_chars, max_chars=max_chars,
-        embeds_path=embeddings_path, extraction_model=extraction_model,
-        embed_model=embed_model, embed_client=openai_client,
-        extraction_client=extraction_client,
-        **extract_kwargs
-    )
+    if batch:
+        # Retrieve top chunk per article, and submit through the Batch API
+        search_query = extract_kwargs.pop('search_query')
+        top = retrieve_chunks(
+            docs, min_chars, max_chars, store, openai_client, embed_model,
+            search_query
+        )
+        batch_extract(
+            top['content'].to_list(), top['pmcid'].to_list(), predictions_path,
+            client=extraction_client, model=extraction_model,
+            meta=top[CHUNK_META].to_dict(orient='records'),
+            work_dir=output_dir / 'batches', **extract_kwargs
+        )
+    else:
+        # Retrieve top chunk per article, and extract (resumes if interrupted)
+        search_extract(
+            articles=docs, output_path=predictions_path,
+            min_chars=min_chars, max_chars=max_chars,
+            store=store, extraction_model=extraction_model,
+            embed_model=embed_model, embed_client=openai_client,
+            extraction_client=extraction_client, cache=cache,
+            **extract_kwargs
+        )
 
-    clean_predictions(predictions).to_csv(
-        clean_predictions_path, index=False
-    )
+    # Streamed in batches, so memory does not grow with the corpus
+    clean_predictions_to_parquet(predictions_path, clean_predictions_path)
 
 
 models = [
@@ -54,4 +76,4 @@ models = [
 # Split body into large sections (by setting min_chars to high number)
 for model_name, client in models:
     _run(model_name, client, 40, 4000, prepend='demographics-zeroshot',
-         **ZERO_SHOT_MULTI_GROUP_FC, num_workers=10)
\ No newline at end of file
+         batch=True, **ZERO_SHOT_MULTI_GROUP_FC)
\ No newline at end of file
@@ -2,16 +2,20 @@
 
 import pandas as pd
 import os
-import json
 from pathlib import Path
-from publang.extract import extract_from_text
 from nipub_templates.demographics.clean import clean_predictions
 from nipub_templates.demographics_orig import ZERO_SHOT_MULTI_GROUP
+from utils.async_extract import extract_to_jsonl
+from utils.batch import batch_extract
+from utils.cache import ExtractionCache
 from openai import OpenAI
 
 
 output_dir = Path('outputs')
 
+# Responses are cached across runs, keyed by model, prompt and schema
+cache = ExtractionCache('outputs/llm_cache.sqlite')
+
 # Set up OpenAI clients
 openai_client = OpenAI(api_key=os.getenv('MYOPENAI_API_KEY'))
 
@@ -20,35 +24,32 @@ docs = pd.read_csv('data/kendra_abstracts.csv')
 docs = docs[docs.abstract.isna() == False]
 
 
-def _run(model_name, extraction_client, prepend='', **kwargs):
+def _run(model_name, extraction_client, prepend='', batch=False, **kwargs):
     prepend += '_'
     short_model_name = model_name.split('/')[-1]
 
     kwargs.pop('search_query', None)
 
     name = f"metaabstracts_{prepend}{short_model_name}"
-    predictions_path = output_dir / f'{name}.json'
+    predictions_path = output_dir / f'{name}.jsonl'
     clean_predictions_path = output_dir / f'{name}_clean.csv'
 
-
-    # Extract
-    predictions = extract_from_text(
-        docs['abstract'].to_list(),
-        model=model_name, client=extraction_client,
-        num_workers=10,
-        **kwargs
-    )
-
-    # Add abstract id to predictions
-    outputs = []
-    for pred, _id in zip(predictions, docs['id']):
-        if pred:
-            pred['id'] = _id
-            outputs.append(pred)
-
-    json.dump(outputs, open(predictions_path, 'w'))
-
-    clean_predictions(outputs).to_csv(
+    if batch:
+        # Submit through the Batch API (resumes polling if interrupted)
+        batch_extract(
+            docs['abstract'].to_list(), docs['id'].to_list(), predictions_path,
+            client=extraction_client, model=model_name, id_key='id',
+            work_dir=output_dir / 'batches', **kwargs
+        )
+    else:
+        # Extract, streaming each prediction to disk (resumes if interrupted)
+        extract_to_jsonl(
+            docs['abstract'].to_list(), docs['id'].to_list(), predictions_path,
+            id_key='id', model=model_name, client=extraction_client,
+            cache=cache, **kwargs
+        )
+
+    clean_predictions(predictions_path).to_csv(
         clean_predictions_path, index=False
     )
 
@@ -61,5 +62,5 @@ models = [
 # Split body into large sections (by setting min_chars to high number)
 # Running this using the original prompt from the lit mining paper.
 for model_name, client in models:
-    _run(model_name, client, prepend='demographics-abstracts-2', 
+    _run(model_name, client, prepend='demographics-abstracts-2', batch=True,
          **ZERO_SHOT_MULTI_GROUP)
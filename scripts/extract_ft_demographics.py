@@ -2,26 +2,30 @@
 import os
 import pandas as pd
 from publang.pipelines import search_extract
-from publang.extract import extract_from_text
 from openai import OpenAI
 from pathlib import Path
 from labelrepo.projects.participant_demographics import \
         get_participant_demographics
 from labelrepo import database
-import json
 
 # Change directory for importing
 import sys
 sys.path.append('../')
 from nipub_templates.demographics.prompts import ZERO_SHOT_MULTI_GROUP_FC, ZERO_SHOT_MULTI_GROUP_FTSTRICT_FC
 from nipub_templates.demographics.clean import clean_predictions
+from utils.async_extract import extract_to_jsonl
+from utils.cache import ExtractionCache
+from utils.html_ingest import load_html_corpus
 
 
-html_docs = pd.read_csv('../data/html_combined.csv')
+html_docs = load_html_corpus('../data/html_combined')
 html_docs = html_docs[html_docs.complete == True]
 
 output_dir = Path('../outputs/demographicsextractions')
 
+# Responses are cached across runs, keyed by model, prompt and schema
+cache = ExtractionCache('../outputs/llm_cache.sqlite')
+
 # Set up OpenAI clients
 embed_model = 'text-embedding-ada-002'
 # openai_client = OpenAI(api_key=os.getenv('MYOPENAI_API_KEY'))
@@ -56,26 +60,17 @@ def _run(extraction_model, extraction_client, docs, prepend='', **extract_kwargs
     extract_kwargs.pop('search_query', None)
 
     name = f"full_{prepend}{short_model_name}"
-    predictions_path = output_dir / f'{name}.json'
+    predictions_path = output_dir / f'{name}.jsonl'
     clean_predictions_path = output_dir / f'{name}_clean.csv'
 
-    # Extract
-    predictions = extract_from_text(
-        docs['text'].to_list(),
-        model=extraction_model, client=extraction_client,
-        **extract_kwargs
+    # Extract, streaming each prediction to disk (resumes if interrupted)
+    extract_to_jsonl(
+        docs['text'].to_list(), docs['pmcid'].to_list(), predictions_path,
+        id_key='pmcid', model=extraction_model, client=extraction_client,
+        cache=cache, **extract_kwargs
     )
 
-    # Add abstract id to predictions
-    outputs = []
-    for pred, _id in zip(predictions, docs['pmcid']):
-        if pred:    
-            pred['pmcid'] = _id
-            outputs.append(pred)
-
-    json.dump(outputs, open(predictions_path, 'w'))
-
-    clean_predictions(predictions).to_csv(
+    clean_predictions(predictions_path).to_csv(
         clean_predictions_path, index=False
     )
 
@@ -89,8 +84,8 @@ models = [
 
 # for model_name, client in models:
 #     _run(model_name, client, html_docs, prepend='html_demographics-zeroshot',
-#          **ZERO_SHOT_MULTI_GROUP_FC, num_workers=10)
+#          **ZERO_SHOT_MULTI_GROUP_FC)
 
 for model_name, client in models:
     _run(model_name, client, md_docs, prepend='md_demographics-zeroshot',
-         **ZERO_SHOT_MULTI_GROUP_FC, num_workers=10)
+         **ZERO_SHOT_MULTI_GROUP_FC)
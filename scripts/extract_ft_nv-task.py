@@ -1,15 +1,15 @@
 """ Extract participant demographics from HTML files. """
 import os
-from publang.extract import extract_from_text
 from openai import OpenAI
 from pathlib import Path
-import json
 import pandas as pd
 
 # Change directory for importing
 import sys
 sys.path.append('../')
 from nipub_templates.nv_task.prompts import ZERO_SHOT_TASK
+from utils.async_extract import extract_to_jsonl
+from utils.cache import ExtractionCache
 
 
 # Read JSON lines
@@ -18,6 +18,9 @@ docs = pd.read_json('../../labelbuddy-annotations/projects/nv_task/documents/tas
 output_dir = Path('../outputs/nv_task/extractions')
 output_dir.mkdir(parents=True, exist_ok=True)
 
+# Responses are cached across runs, keyed by model, prompt and schema
+cache = ExtractionCache('../outputs/llm_cache.sqlite')
+
 # Set up OpenAI clients
 openai_client = OpenAI(api_key=os.getenv('MYOPENAI_API_KEY'))
 
@@ -29,24 +32,15 @@ def _run(extraction_model, extraction_client, docs, prepend='', **extract_kwargs
     pmcids = [d['pmcid'] for d in docs['metadata']]
 
     name = f"full_{prepend}{short_model_name}"
-    predictions_path = output_dir / f'{name}.json'
+    predictions_path = output_dir / f'{name}.jsonl'
 
-    # Extract
-    predictions = extract_from_text(
-        docs['text'].to_list(),
-        model=extraction_model, client=extraction_client,
-        **extract_kwargs
+    # Extract, streaming each prediction to disk (resumes if interrupted)
+    extract_to_jsonl(
+        docs['text'].to_list(), pmcids, predictions_path,
+        id_key='pmcid', model=extraction_model, client=extraction_client,
+        cache=cache, **extract_kwargs
     )
 
-    # Add abstract id to predictions
-    outputs = []
-    for pred, _id in zip(predictions, pmcids):
-        if pred:    
-            pred['pmcid'] = _id
-            outputs.append(pred)
-
-    json.dump(outputs, open(predictions_path, 'w'))
-
 
 models = [
     ("gpt-4o-2024-08-06", openai_client, {"temperature": 1}),
@@ -56,4 +50,4 @@ models = [
 
 for model_name, client, kwargs in models:
     _run(model_name, client, docs, prepend='lb_nv_taskstructured-zeroshot',
-         **ZERO_SHOT_TASK, num_workers=10, **kwargs)
+         **ZERO_SHOT_TASK, **kwargs)
@@ -0,0 +1,22 @@
+""" Load cleaned, abbreviation-resolved and UMLS-linked prediction CSVs into
+the partitioned parquet prediction store (run metadata from file names).
+Re-running replaces the stored runs, so it can be used to sync new outputs.
+"""
+import pandas as pd
+from pathlib import Path
+
+# Change directory for importing
+import sys
+sys.path.append('../')
+from utils.prediction_store import PredictionStore, STAGES, parse_run_name
+
+extractions_dir = Path('../outputs/demographics/extractions')
+store = PredictionStore('../outputs/demographics/predictions')
+
+for stage in STAGES:
+    for f in sorted(extractions_dir.glob(f'*_{stage}.csv')):
+        run = parse_run_name(f.stem)
+        print(f"Storing {f.name}: {run}")
+        store.write(pd.read_csv(f), **run)
+
+print(store.runs().groupby(['stage', 'strategy']).size())
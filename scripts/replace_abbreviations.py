@@ -1,16 +1,24 @@
 """ Uses scispacy to replace abbreviations from LLM outputs
 For now only applies to "diagnosis" field
  """
-import spacy
-from scispacy.abbreviation import AbbreviationDetector
 from labelrepo import database
 import pandas as pd
 from pathlib import Path
-from tqdm import tqdm
-import re
 
-nlp = spacy.load("en_core_sci_sm")
-nlp.add_pipe("abbreviation_detector")
+# Change directory for importing
+import sys
+sys.path.append('../')
+from utils.html_ingest import load_html_corpus
+from utils.abbreviations import (
+    AbbreviationStore, lookup_abbreviations, lookup_window_abbreviations,
+    replace_abbreviations)
+
+# Parsed abbreviation tables, per text source (offsets differ across sources)
+abbrev_dir = Path('../outputs/abbreviations')
+
+# For chunked predictions, only parse this many characters around each chunk
+# (None parses whole documents)
+window_margin = 1000
 
 def load_docs(pmids, source='md'):
     if source == 'md':
@@ -22,7 +30,7 @@ def load_docs(pmids, source='md'):
             docs.pmcid.isin(pmids)].to_dict(orient='records')
 
     elif source == 'html':
-        docs = pd.read_csv('../data/html_combined.csv')
+        docs = load_html_corpus('../data/html_combined', columns=['pmcid', 'text'])
         docs = docs[docs.pmcid.isin(pmids)].to_dict(orient='records')
 
     # Turn into dictionary with key as pmcid
@@ -30,75 +38,56 @@ def load_docs(pmids, source='md'):
     return docs
 
 
-def replace_abbreviations(doc, target, start_char=None, end_char=None, remove_parenth=True):
-    """
-    Replace abbreviations in the target string with their long form
-
-    Args:
-        doc: spacy doc object
-        target: target string to replace abbreviations in
-        start_char: start char of the target in the doc
-        end_char: end char of the target in the doc
-        remove_parenth: whether to remove content in parentheses after the abbreviation
-    """
-    for abrv in doc._.abbreviations:
-        if abrv.text in target and not abrv.text in abrv._.long_form.text:
-            # If start and end char are provided, only resolve abbreviations within the target
-            if start_char is not None and end_char is not None:
-                if not (abrv.start_char >= start_char and abrv.end_char <= end_char):
-                    continue 
-
-            if remove_parenth:
-                # If abbreviation is enclosed in parentheses, remove the content in parentheses
-                target = re.sub(rf'\({abrv.text}\)', '', target)
-                
-            target = target.replace(abrv.text, abrv._.long_form.text)
-
-    return target.strip()
-
-
-def run_abbrev(docs, predictions):
-    for pmcid, preds in tqdm(predictions.groupby('pmcid'), total=len(predictions.pmcid.unique())):
-        processed_doc = nlp(docs[pmcid]['text'])
-
-        for ix, pred in preds.iterrows():
-            # Get the UMLS entities that match the targettarg
-            start_char = pred['start_char'] if 'start_char' in pred else None
-            end_char = pred['end_char'] if 'end_char' in pred else None
-
-            
-            if pred['group_name'] == 'patients' and pd.isna(pred['diagnosis']) == False:
-                target_noabbrev = replace_abbreviations(
-                    processed_doc, pred['diagnosis'], start_char=start_char, end_char=end_char)
-                
-                if target_noabbrev != pred['diagnosis']:
-                    predictions.loc[ix, 'diagnosis'] = target_noabbrev
-                    continue
+def run_abbrev(abbreviations, predictions):
+    patients = (predictions['group_name'] == 'patients') & predictions['diagnosis'].notna()
+    predictions.loc[patients, 'diagnosis'] = replace_abbreviations(
+        abbreviations, predictions[patients], column='diagnosis')
 
     return predictions
 
 
-# Apply to all predictions, with different sources
-# Apply to all predictions, with different sources
-output_dir = Path('../outputs/demographicsextractions')
-all_files = list(output_dir.glob('chunked_*zeroshot*_clean.csv')) + list(output_dir.glob('full_*zeroshot*_clean.csv'))
-
-
-for pred_path in all_files:
+def abbreviate_file(pred_path, out_name):
+    """ Resolve abbreviations of one _clean.csv file into out_name """
+    pred_path = Path(pred_path)
     strategy = pred_path.stem.split('_')[0]
     if strategy == 'chunked':
         source = 'md'
     else:
         source = pred_path.stem.split('_')[1]
-        
-    out_name = Path(str(pred_path).replace('_clean', '_noabbrev'))
-    if out_name.exists():
-        continue
-    
-    print(f'Processing {pred_path}')
+
     predictions = pd.read_csv(pred_path)
-    docs = load_docs(predictions.pmcid.unique(), source)
-    predictions = run_abbrev(docs, predictions)
+    get_texts = lambda pmcids: {
+        pmcid: doc['text'] for pmcid, doc in load_docs(pmcids, source).items()}
+
+    if strategy == 'chunked' and window_margin is not None:
+        # Detector on each chunk plus margin, and a document-level index of
+        # first definitions for short forms defined outside the window
+        abbreviations = lookup_window_abbreviations(
+            AbbreviationStore(abbrev_dir / f'{source}_window-{window_margin}'),
+            get_texts(predictions.pmcid.unique()), predictions,
+            margin=window_margin, n_process=4, batch_size=32,
+        )
+    else:
+        # Only documents not parsed by a previous run are loaded and parsed
+        abbreviations = lookup_abbreviations(
+            AbbreviationStore(abbrev_dir / source), predictions.pmcid.unique(),
+            load_docs=get_texts, n_process=4, batch_size=32,
+        )
+    predictions = run_abbrev(abbreviations, predictions)
 
-    # Remove _clean from the filename
     predictions.to_csv(out_name, index=False)
+
+
+if __name__ == '__main__':
+    # Apply to all predictions, with different sources
+    output_dir = Path('../outputs/demographicsextractions')
+    all_files = list(output_dir.glob('chunked_*zeroshot*_clean.csv')) + list(output_dir.glob('full_*zeroshot*_clean.csv'))
+
+    for pred_path in all_files:
+        # Remove _clean from the filename
+        out_name = Path(str(pred_path).replace('_clean', '_noabbrev'))
+        if out_name.exists():
+            continue
+
+        print(f'Processing {pred_path}')
+        abbreviate_file(pred_path, out_name)
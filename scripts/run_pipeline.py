@@ -0,0 +1,116 @@
+""" Incremental post-processing pipeline:
+raw predictions -> clean -> abbreviations -> UMLS -> prediction store -> evaluation
+
+Only stages whose inputs, code or parameters changed since their last run
+are executed (see utils/pipeline.py), and independent runs are processed in
+parallel. Extraction itself (paid API calls) is run separately; its raw
+prediction files are the inputs of the pipeline.
+"""
+import logging
+import runpy
+import os
+from pathlib import Path
+
+# Change directory for importing
+import sys
+sys.path.append('../')
+from nipub_templates.demographics.clean import clean_predictions
+from utils.pipeline import Pipeline, Stage
+from utils.prediction_store import PredictionStore, parse_run_name
+
+logging.basicConfig(level=logging.INFO)
+
+extractions_dir = Path('../outputs/demographics/extractions')
+store = PredictionStore('../outputs/demographics/predictions')
+repo = Path('..')
+
+# Runs that go through abbreviation resolution and UMLS linking
+LINKED_RUNS = ['chunked_*zeroshot*', 'full_*zeroshot*']
+
+# Stages holding a resource at once: one CandidateGenerator in memory
+UMLS_LIMITS = {'umls': 1}
+
+
+def clean_stage(raw_path, out_path):
+    clean_predictions(raw_path).to_csv(out_path, index=False)
+
+
+def abbrev_stage(clean_path, out_path):
+    from replace_abbreviations import abbreviate_file
+    abbreviate_file(clean_path, out_path)
+
+
+def umls_stage(noabbrev_path, out_path):
+    from extract_umls import link_file
+    link_file(noabbrev_path, out_path)
+
+
+def store_stage(csv_path, partition_path):
+    import pandas as pd
+    store.write(pd.read_csv(csv_path), **parse_run_name(Path(csv_path).stem))
+
+
+def evaluate_stage(*paths):
+    runpy.run_path('evaluate_demographics.py', run_name='__main__')
+
+
+def build_pipeline():
+    pipeline = Pipeline('../outputs/demographics/pipeline_state.json')
+    clean_partitions = []
+
+    raw_files = sorted(
+        list(extractions_dir.glob('*.json')) + list(extractions_dir.glob('*.jsonl')))
+    for raw_path in raw_files:
+        name = raw_path.stem
+        run = parse_run_name(name)
+        if run['model'] is None or run['stage'] != 'raw':
+            continue
+
+        outputs = {'clean': extractions_dir / f'{name}_clean.csv'}
+        pipeline.add(Stage(
+            f'clean:{name}', clean_stage, [raw_path], [outputs['clean']],
+            code=[repo / 'nipub_templates/demographics/clean.py'],
+        ))
+
+        if any(raw_path.match(f'{pattern}.json*') for pattern in LINKED_RUNS):
+            outputs['noabbrev'] = extractions_dir / f'{name}_noabbrev.csv'
+            outputs['umls'] = extractions_dir / f'{name}_umls.csv'
+            pipeline.add(Stage(
+                f'noabbrev:{name}', abbrev_stage, [outputs['clean']],
+                [outputs['noabbrev']],
+                code=['replace_abbreviations.py', repo / 'utils/abbreviations.py'],
+            ))
+            # Linking stages hold the candidate generator (unless serve_umls
+            # is running), so they run one at a time (see UMLS_LIMITS)
+            pipeline.add(Stage(
+                f'umls:{name}', umls_stage, [outputs['noabbrev']],
+                [outputs['umls']],
+                code=['extract_umls.py', repo / 'utils/umls.py'],
+                resource='umls',
+            ))
+
+        for stage, csv_path in outputs.items():
+            partition = store.partition_path(**{**run, 'stage': stage})
+            pipeline.add(Stage(
+                f'store-{stage}:{name}', store_stage, [csv_path], [partition],
+                code=[repo / 'utils/prediction_store.py'],
+            ))
+            if stage == 'clean' and run['strategy'] in ('chunked', 'full'):
+                clean_partitions.append(partition)
+
+    pipeline.add(Stage(
+        'evaluate', evaluate_stage, clean_partitions + [Path('../annotations/combined_pd.csv')],
+        [extractions_dir / 'chunked_results.csv', extractions_dir / 'full_results.csv'],
+        code=['evaluate_demographics.py', repo / 'utils/evaluation.py'],
+    ))
+    return pipeline
+
+
+if __name__ == '__main__':
+    pipeline = build_pipeline()
+    # Set DRY_RUN=1 to list stale stages without running them
+    status = pipeline.run(
+        max_workers=4, dry_run=bool(os.getenv('DRY_RUN')), limits=UMLS_LIMITS)
+    for name, result in sorted(status.items()):
+        if result != 'fresh':
+            print(f'{result:>8} {name}')
@@ -0,0 +1,16 @@
+""" Long-lived UMLS linker service
+
+Loads the scispacy UMLS candidate generator once and serves it on localhost,
+so extract_umls.py (and notebooks) do not reload the index on every run.
+Leave running in a separate terminal.
+"""
+import logging
+
+# Change directory for importing
+import sys
+sys.path.append('../')
+from utils.umls_service import serve
+
+logging.basicConfig(level=logging.INFO)
+
+serve(host='127.0.0.1', port=8765, name='umls')
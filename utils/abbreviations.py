@@ -0,0 +1,440 @@
+""" Batched, multi-process abbreviation extraction with persisted results
+
+Each document is parsed once with scispacy's abbreviation detector, and its
+(short form, long form, span offsets) table is stored as parquet. Later
+consumers look abbreviations up instead of re-parsing the paper.
+"""
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# The detector only matches on token text, so no trained component is needed
+_UNUSED_COMPONENTS = [
+    'tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer', 'parser', 'ner']
+
+SCHEMA = pa.schema([
+    ('pmcid', pa.int64()),
+    ('short_form', pa.string()),
+    ('long_form', pa.string()),
+    ('short_start', pa.int64()),
+    ('short_end', pa.int64()),
+    ('long_start', pa.int64()),
+    ('long_end', pa.int64()),
+    # Span of the document that was parsed (null: the whole document)
+    ('window_start', pa.int64()),
+    ('window_end', pa.int64()),
+])
+
+_nlp = None
+
+
+def load_nlp(model='en_core_sci_sm'):
+    """ Tokenizer-only pipeline with the abbreviation detector """
+    import spacy
+    from scispacy.abbreviation import AbbreviationDetector  # noqa: F401
+
+    nlp = spacy.load(model, exclude=_UNUSED_COMPONENTS)
+    nlp.add_pipe("abbreviation_detector")
+    return nlp
+
+
+def _init_worker(model):
+    global _nlp
+    _nlp = load_nlp(model)
+
+
+def _abbreviation_records(key, doc):
+    """ Records of a parsed text; key is (pmcid, window_start, window_end) """
+    pmcid, window_start, window_end = key
+    offset = window_start or 0
+    window = {'window_start': window_start, 'window_end': window_end}
+    records = []
+    for abrv in doc._.abbreviations:
+        long_form = abrv._.long_form
+        records.append({
+            'pmcid': pmcid,
+            'short_form': abrv.text,
+            'long_form': long_form.text,
+            'short_start': abrv.start_char + offset,
+            'short_end': abrv.end_char + offset,
+            'long_start': long_form.start_char + offset,
+            'long_end': long_form.end_char + offset,
+            **window,
+        })
+    if not records:
+        # Marks the document (or window) as processed
+        records.append({'pmcid': pmcid, **window})
+    return records
+
+
+def _process_batch(batch, batch_size=32):
+    records = []
+    docs = _nlp.pipe(batch, as_tuples=True, batch_size=batch_size)
+    for doc, key in docs:
+        records.extend(_abbreviation_records(key, doc))
+    return records
+
+
+class AbbreviationStore:
+    """ Per-document abbreviation tables, as parquet parts in `directory`.
+
+    Documents without abbreviations have a single row with null short_form,
+    so that they are not parsed again. Windowed tables (see
+    update_window_abbreviations) should be kept in their own directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _dataset(self):
+        return ds.dataset(self.directory, schema=SCHEMA, format='parquet')
+
+    def processed(self):
+        """ pmcids parsed as whole documents """
+        table = self._dataset().to_table(
+            columns=['pmcid'], filter=ds.field('window_start').is_null())
+        return set(pc.unique(table['pmcid']).to_pylist())
+
+    def processed_windows(self):
+        """ (pmcid, window_start, window_end) of parsed windows """
+        table = self._dataset().to_table(
+            columns=['pmcid', 'window_start', 'window_end'],
+            filter=ds.field('window_start').is_valid())
+        return set(zip(*(table[c].to_pylist() for c in table.column_names)))
+
+    def load(self, pmcids=None):
+        """ Abbreviations of `pmcids` (default: all documents) """
+        filter = None
+        if pmcids is not None:
+            filter = ds.field('pmcid').isin([int(p) for p in pmcids])
+        table = self._dataset().to_table(filter=filter)
+        table = table.filter(pc.is_valid(table['short_form']))
+        return table.to_pandas()
+
+    def add(self, records):
+        if records:
+            pq.write_table(
+                pa.Table.from_pylist(records, schema=SCHEMA),
+                self.directory / f'part-{uuid.uuid4().hex}.parquet')
+
+
+def _parse(store, pending, n_process=4, batch_size=32, docs_per_part=2000,
+           model='en_core_sci_sm'):
+    """ Parse (text, key) pairs in worker processes, storing the records """
+    # Split each part across workers
+    step = max(1, docs_per_part // n_process)
+    with ProcessPoolExecutor(
+            n_process, initializer=_init_worker, initargs=(model,)) as ex:
+        for start in range(0, len(pending), docs_per_part):
+            part = pending[start:start + docs_per_part]
+            batches = [part[i:i + step] for i in range(0, len(part), step)]
+            records = []
+            for batch_records in ex.map(
+                    _process_batch, batches, [batch_size] * len(batches)):
+                records.extend(batch_records)
+            store.add(records)
+    return len(pending)
+
+
+def update_abbreviations(store, docs, **kwargs):
+    """ Parse documents not yet in the store, and persist their tables.
+
+    Args:
+        store: AbbreviationStore
+        docs: dict of pmcid -> text, or iterable of (pmcid, text)
+        kwargs: n_process (worker processes, each loading the pipeline
+            once), batch_size (documents per nlp.pipe batch), docs_per_part
+            (documents per parquet part, a unit of progress) and model
+    Returns:
+        number of documents parsed
+    """
+    if isinstance(docs, dict):
+        docs = docs.items()
+    done = store.processed()
+    pending = [(text, (int(pmcid), None, None)) for pmcid, text in docs
+               if int(pmcid) not in done and isinstance(text, str)]
+    return _parse(store, pending, **kwargs)
+
+
+def text_windows(docs, spans, margin=1000):
+    """ Windows of `margin` characters around each span, clipped to the text
+
+    Args:
+        docs: dict of pmcid -> text
+        spans: DataFrame with pmcid, start_char and end_char
+    Returns:
+        DataFrame of unique pmcid, window_start, window_end
+    """
+    spans = spans[['pmcid', 'start_char', 'end_char']].dropna()
+    spans = spans[spans['pmcid'].isin(list(docs))].drop_duplicates()
+    lengths = spans['pmcid'].map(lambda p: len(docs[p]))
+    return pd.DataFrame({
+        'pmcid': spans['pmcid'].astype('int64'),
+        'window_start': (spans['start_char'] - margin).clip(lower=0)
+        .astype('int64'),
+        'window_end': (spans['end_char'] + margin).clip(upper=lengths)
+        .astype('int64'),
+    }).drop_duplicates().reset_index(drop=True)
+
+
+def update_window_abbreviations(store, docs, spans, margin=1000, **kwargs):
+    """ Parse only a context window around each span (e.g. retrieved chunks)
+
+    Args:
+        store: AbbreviationStore (windows are keyed by their offsets)
+        docs: dict of pmcid -> text
+        spans: DataFrame with pmcid, start_char and end_char
+        margin: characters of context on each side of a span
+        kwargs: passed to the parser, as in update_abbreviations
+    Returns:
+        number of windows parsed
+    """
+    windows = text_windows(docs, spans, margin)
+    done = store.processed_windows()
+    pending = [
+        (docs[pmcid][start:end], (pmcid, start, end))
+        for pmcid, start, end in windows.itertuples(index=False, name=None)
+        if (pmcid, start, end) not in done
+    ]
+    return _parse(store, pending, **kwargs)
+
+
+def lookup_abbreviations(store, pmcids, load_docs=None, **kwargs):
+    """ Abbreviation tables for pmcids, parsing only unseen documents.
+
+    Args:
+        store: AbbreviationStore
+        pmcids: documents to look up
+        load_docs: callable, pmcids -> {pmcid: text}, for missing documents
+        kwargs: passed to update_abbreviations
+    Returns:
+        DataFrame of abbreviations for all pmcids
+    """
+    pmcids = [int(p) for p in pmcids]
+    missing = set(pmcids) - store.processed()
+    if missing and load_docs is not None:
+        update_abbreviations(store, load_docs(list(missing)), **kwargs)
+    return store.load(pmcids)
+
+
+@lru_cache(maxsize=4096)
+def _compile(short_forms, remove_parenth):
+    # Longest first, so that e.g. "ADHD" wins over "AD"
+    alternation = '|'.join(
+        re.escape(sf) for sf in sorted(short_forms, key=len, reverse=True))
+    pattern = rf'(?<!\w)({alternation})(?!\w)'
+    if remove_parenth:
+        # Short forms in parentheses (after their long form) are dropped
+        pattern = rf'\s*\((?:{alternation})\)|' + pattern
+    return re.compile(pattern)
+
+
+class AbbreviationReplacer:
+    """ Resolve all short forms of a mapping in a single scan of a string.
+
+    Args:
+        mapping: dict of short form -> long form
+        remove_parenth: remove parenthesized short forms, e.g. "(AD)"
+    """
+
+    def __init__(self, mapping, remove_parenth=True):
+        self.mapping = mapping
+        self.pattern = None
+        if mapping:
+            self.pattern = _compile(tuple(sorted(mapping)), remove_parenth)
+
+    def _sub(self, match):
+        short_form = match.group(1)
+        return '' if short_form is None else self.mapping[short_form]
+
+    def __call__(self, target):
+        if self.pattern is not None:
+            target = self.pattern.sub(self._sub, target)
+        return target.strip()
+
+
+def scoped_mapping(abbreviations, start_char=None, end_char=None):
+    """ Short -> long form mapping of a document's abbreviation table.
+
+    If start_char and end_char are given, only abbreviations occurring
+    within that span of the document are kept.
+    """
+    if pd.notna(start_char) and pd.notna(end_char):
+        abbreviations = abbreviations[
+            (abbreviations['short_start'] >= start_char)
+            & (abbreviations['short_end'] <= end_char)]
+    mapping = {}
+    for short_form, long_form in zip(
+            abbreviations['short_form'], abbreviations['long_form']):
+        if short_form not in mapping and short_form not in long_form:
+            mapping[short_form] = long_form
+    return mapping
+
+
+def replace_abbreviations(abbreviations, predictions, column='diagnosis',
+                          remove_parenth=True):
+    """ Replace abbreviations in a column of predictions by their long form.
+
+    One pattern is compiled per document and span, and applied to all
+    predictions sharing them.
+
+    Args:
+        abbreviations: abbreviation tables (AbbreviationStore.load)
+        predictions: DataFrame with pmcid, `column`, and optionally
+            start_char/end_char of the text each prediction comes from
+        column: text column to resolve
+    Returns:
+        Series of resolved values, aligned with predictions
+    """
+    resolved = predictions[column].copy()
+    by_pmcid = dict(tuple(abbreviations.groupby('pmcid')))
+
+    scope = [c for c in ('start_char', 'end_char') if c in predictions]
+    keys = ['pmcid'] + scope if len(scope) == 2 else ['pmcid']
+    targets = predictions[predictions[column].notna()]
+
+    for key, group in targets.groupby(keys, dropna=False):
+        key = key if isinstance(key, tuple) else (key,)
+        table = by_pmcid.get(key[0])
+        mapping = {}
+        if table is not None:
+            mapping = scoped_mapping(table, *key[1:])
+        replacer = AbbreviationReplacer(mapping, remove_parenth)
+        resolved[group.index] = group[column].map(replacer)
+
+    return resolved
+
+
+# Schwartz & Hearst (2003): "long form (SF)" definitions, found on strings
+_DEFINITION = re.compile(r'\(\s*([^()]{2,10}?)\s*\)')
+_SENTENCE_END = re.compile(r'.*[.;!?](?:\s|$)', re.DOTALL)
+_WORD = re.compile(r'\S+')
+
+
+def _valid_short_form(short_form):
+    return (len(short_form.split()) <= 2 and short_form[0].isalnum()
+            and any(c.isalpha() for c in short_form))
+
+
+def _best_long_form(short_form, candidate):
+    """ Shortest suffix of candidate containing the short form's characters
+    in order, with the first one starting a word """
+    s_idx, l_idx = len(short_form) - 1, len(candidate) - 1
+    while s_idx >= 0:
+        c = short_form[s_idx].lower()
+        if not c.isalnum():
+            s_idx -= 1
+            continue
+        while l_idx >= 0 and (
+                candidate[l_idx].lower() != c
+                or (s_idx == 0 and l_idx > 0
+                    and candidate[l_idx - 1].isalnum())):
+            l_idx -= 1
+        if l_idx < 0:
+            return None
+        l_idx -= 1
+        s_idx -= 1
+    return candidate[candidate.rfind(' ', 0, l_idx + 1) + 1:]
+
+
+def definition_index(text, max_context=300):
+    """ First definition of each short form in a document.
+
+    A cheap, regex-based pass over the whole text, so that short forms in a
+    parsed window can be resolved when they were defined earlier.
+
+    Returns:
+        dict of short form -> (long form, long_start, long_end)
+    """
+    index = {}
+    for match in _DEFINITION.finditer(text):
+        short_form = match.group(1)
+        if short_form in index or not _valid_short_form(short_form):
+            continue
+
+        # Words before the parenthesis, within the same sentence
+        context_start = max(0, match.start() - max_context)
+        context = text[context_start:match.start()]
+        sentence_end = _SENTENCE_END.match(context)
+        if sentence_end:
+            context_start += sentence_end.end()
+        words = list(_WORD.finditer(text, context_start, match.start()))
+        n_words = min(len(short_form) + 5, len(short_form) * 2)
+        if not words:
+            continue
+        candidate_start = words[-n_words:][0].start()
+        candidate = text[candidate_start:match.start()].rstrip()
+
+        long_form = _best_long_form(short_form, candidate)
+        if not long_form or len(long_form) <= len(short_form) \
+                or short_form in long_form:
+            continue
+        long_start = candidate_start + len(candidate) - len(long_form)
+        index[short_form] = (long_form, long_start, long_start + len(long_form))
+    return index
+
+
+def indexed_abbreviations(docs, windows):
+    """ Occurrences, within each window, of short forms defined anywhere in
+    the document, as abbreviation table rows
+
+    Args:
+        docs: dict of pmcid -> text
+        windows: DataFrame with pmcid, window_start, window_end
+    """
+    records = []
+    for pmcid, group in windows.groupby('pmcid'):
+        text = docs[pmcid]
+        index = definition_index(text)
+        if not index:
+            continue
+        pattern = _compile(tuple(sorted(index)), False)
+        for start, end in zip(group['window_start'], group['window_end']):
+            for match in pattern.finditer(text, start, end):
+                long_form, long_start, long_end = index[match.group(1)]
+                records.append({
+                    'pmcid': pmcid,
+                    'short_form': match.group(1),
+                    'long_form': long_form,
+                    'short_start': match.start(),
+                    'short_end': match.end(),
+                    'long_start': long_start,
+                    'long_end': long_end,
+                    'window_start': start,
+                    'window_end': end,
+                })
+    return pd.DataFrame.from_records(records, columns=SCHEMA.names)
+
+
+def lookup_window_abbreviations(store, docs, spans, margin=1000, **kwargs):
+    """ Abbreviation tables for spans, parsing only a window around each.
+
+    Short forms found by the detector within a window come first (they take
+    precedence in scoped_mapping), followed by short forms defined elsewhere
+    in the document, from definition_index.
+
+    Args:
+        store: AbbreviationStore for windowed tables
+        docs: dict of pmcid -> text
+        spans: DataFrame with pmcid, start_char and end_char
+        margin: characters of context on each side of a span
+        kwargs: passed to update_window_abbreviations
+    """
+    update_window_abbreviations(store, docs, spans, margin, **kwargs)
+    windows = text_windows(docs, spans, margin)
+    detected = store.load(windows['pmcid'].unique())
+    detected = detected.merge(windows, on=list(windows.columns))
+    indexed = indexed_abbreviations(docs, windows)
+    if indexed.empty:
+        return detected
+    return pd.concat([detected, indexed], ignore_index=True)
+
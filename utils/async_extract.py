@@ -0,0 +1,268 @@
+""" Asyncio extraction engine with per-provider concurrency pools """
+import asyncio
+import json
+from itertools import repeat
+import logging
+from string import Template
+
+from openai import AsyncOpenAI
+
+from .cache import request_key
+from .jsonl import JSONLWriter, completed_ids
+from .validation import SchemaError, get_validator
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of concurrent requests per provider (keyed by API host)
+PROVIDER_CONCURRENCY = {
+    'api.openai.com': 64,
+    'api.fireworks.ai': 32,
+    'openrouter.ai': 32,
+}
+DEFAULT_CONCURRENCY = 16
+
+
+def render_messages(messages, text):
+    """ Substitute ${text} into each message template """
+    return [
+        {**m, 'content': Template(m['content']).safe_substitute(text=text)}
+        for m in messages
+    ]
+
+
+def tool_kwargs(output_schema):
+    """ Request arguments forcing a call to the extractData function """
+    return {
+        "tools": [{
+            "type": "function",
+            "function": {"name": "extractData", "parameters": output_schema}
+        }],
+        "tool_choice": {"type": "function", "function": {"name": "extractData"}}
+    }
+
+
+class ProviderPool:
+    """ One async client and one concurrency limit per provider.
+
+    Clients passed in (e.g. `openai_client`, `fireworks_client`) are keyed by
+    their API host, so all runs against the same provider share a pool.
+    Must be created and used within a single event loop.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {**PROVIDER_CONCURRENCY, **(limits or {})}
+        self._clients = {}
+        self._semaphores = {}
+
+    def get(self, client):
+        key = client.base_url.host
+        if key not in self._clients:
+            if not isinstance(client, AsyncOpenAI):
+                client = AsyncOpenAI(
+                    api_key=client.api_key, base_url=client.base_url,
+                    max_retries=client.max_retries, timeout=client.timeout
+                )
+            self._clients[key] = client
+            self._semaphores[key] = asyncio.Semaphore(
+                self.limits.get(key, DEFAULT_CONCURRENCY))
+        return self._clients[key], self._semaphores[key]
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
+
+
+async def _request(client, semaphore, model, messages, output_schema,
+                   **kwargs):
+    async with semaphore:
+        response = await client.chat.completions.create(
+            model=model, messages=messages,
+            **tool_kwargs(output_schema), **kwargs
+        )
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        return None
+    try:
+        return json.loads(tool_calls[0].function.arguments)
+    except json.JSONDecodeError:
+        return None
+
+
+async def _extract(client, semaphore, model, messages, output_schema,
+                   cache=None, validator=None, max_retries=2, **kwargs):
+    if cache is not None:
+        key = request_key(model, messages, output_schema, **kwargs)
+        cached = cache.get(key)
+        if cached is not None:
+            return validator.repair_or_none(cached) if validator else cached
+
+    for attempt in range(max_retries + 1):
+        result = await _request(
+            client, semaphore, model, messages, output_schema, **kwargs)
+        if validator is None:
+            break
+        try:
+            # Repaired in place of the raw response; retry only if unusable
+            result = validator(result)
+            break
+        except SchemaError as e:
+            if attempt == max_retries:
+                validator.record_failure()
+                logger.warning(f"Invalid response from {model}: {e}")
+                return None
+            validator.record_retry()
+
+    if cache is not None and result is not None:
+        cache.set(key, result)
+    return result
+
+
+async def aextract_from_text(texts, model, client, messages, output_schema,
+                             pool, max_in_flight=100, cache=None,
+                             on_result=None, validate=True,
+                             max_retries=2, **kwargs):
+    """ Extract from each text, with at most `max_in_flight` pending texts.
+
+    Args:
+        texts: iterable of texts (may be a lazy generator)
+        model: extraction model name
+        client: OpenAI client, used to pick the provider pool
+        messages: message templates, with ${text} placeholder
+        output_schema: JSON schema for the extractData function
+        pool: ProviderPool shared across runs
+        max_in_flight: bound on the queue of texts waiting for a slot
+        cache: optional ExtractionCache, checked before calling the API
+        on_result: optional callback(ix, prediction), called as each text
+            finishes. If given, predictions are not kept in memory.
+        validate: validate and repair responses against output_schema
+            (see utils.validation); unrecoverable ones are retried
+        max_retries: retries of unrecoverable responses
+        kwargs: extra arguments for chat.completions.create (e.g. temperature)
+
+    Returns:
+        list of predictions aligned with texts (None if extraction failed),
+        or None if `on_result` is given
+    """
+    async_client, semaphore = pool.get(client)
+    validator = get_validator(output_schema) if validate else None
+    queue = asyncio.Queue(maxsize=max_in_flight)
+    results = {}
+
+    async def producer(n_workers):
+        for ix, text in enumerate(texts):
+            await queue.put((ix, text))
+        for _ in range(n_workers):
+            await queue.put(None)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            ix, text = item
+            try:
+                result = await _extract(
+                    async_client, semaphore, model,
+                    render_messages(messages, text), output_schema,
+                    cache=cache, validator=validator,
+                    max_retries=max_retries, **kwargs
+                )
+            except Exception as e:
+                logger.warning(f"Extraction {ix} with {model} failed: {e}")
+                result = None
+
+            if on_result is not None:
+                on_result(ix, result)
+            else:
+                results[ix] = result
+
+    n_workers = max_in_flight
+    await asyncio.gather(
+        producer(n_workers), *[worker() for _ in range(n_workers)])
+
+    if validator is not None:
+        logger.info(f"Validation of {model} responses: {validator.rates()}")
+
+    if on_result is None:
+        return [results[ix] for ix in range(len(results))]
+
+
+def run_extractions(jobs, limits=None, max_in_flight=100, cache=None):
+    """ Run several extraction jobs concurrently, sharing provider pools.
+
+    Args:
+        jobs: list of dicts with keyword arguments for aextract_from_text
+        limits: overrides for PROVIDER_CONCURRENCY, keyed by API host
+        cache: optional ExtractionCache shared by all jobs
+    Returns:
+        list of prediction lists, one per job
+    """
+    async def _run():
+        pool = ProviderPool(limits)
+        try:
+            return await asyncio.gather(*[
+                aextract_from_text(
+                    pool=pool, cache=cache,
+                    **{'max_in_flight': max_in_flight, **job})
+                for job in jobs
+            ])
+        finally:
+            await pool.close()
+
+    return asyncio.run(_run())
+
+
+def extract_from_text(texts, model, client, messages, output_schema,
+                      limits=None, max_in_flight=100, cache=None, **kwargs):
+    """ Drop-in for publang's extract_from_text, using the async engine """
+    kwargs.pop('num_workers', None)
+    job = dict(texts=texts, model=model, client=client, messages=messages,
+               output_schema=output_schema, **kwargs)
+    return run_extractions(
+        [job], limits=limits, max_in_flight=max_in_flight, cache=cache)[0]
+
+
+def extract_to_jsonl(texts, ids, output_path, id_key='pmcid', meta=None,
+                     resume=True, retry_failed=False, **kwargs):
+    """ Stream predictions to an append-only JSONL file as texts finish.
+
+    Each prediction is written with its id under `id_key`. Failed or empty
+    extractions are written as marker records, {id_key: ..., "error":
+    "failed"} or {..., "error": "empty"}, without groups.
+    With `resume=True`, ids that already have a record are skipped, so an
+    interrupted run can be restarted with the same call.
+
+    Args:
+        texts: iterable of texts
+        ids: iterable of ids (e.g. pmcids), aligned with texts
+        output_path: JSONL file to append to
+        meta: optional iterable of dicts (e.g. chunk offsets), aligned with
+            texts, added to each record
+        retry_failed: when resuming, extract again ids whose extraction
+            failed
+        kwargs: arguments for extract_from_text (model, client, ...)
+    """
+    done = completed_ids(output_path, id_key, retry_failed) if resume else set()
+    if done:
+        logger.info(f"Resuming: skipping {len(done)} completed documents")
+
+    if meta is None:
+        meta = repeat({})
+    # {text index: id and meta}, until the prediction is written
+    pending = {}
+
+    def _pending():
+        ix = 0
+        for _id, text, m in zip(ids, texts, meta):
+            if _id not in done:
+                pending[ix] = {**m, id_key: _id}
+                ix += 1
+                yield text
+
+    with JSONLWriter(output_path) as writer:
+        def _write(ix, pred):
+            record = pending.pop(ix)
+            if pred is None:
+                record['error'] = 'failed'
+            elif not pred:
+                record['error'] = 'empty'
+            writer.write({**(pred or {}), **record})
+
+        extract_from_text(_pending(), on_result=_write, **kwargs)
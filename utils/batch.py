@@ -0,0 +1,226 @@
+""" OpenAI Batch API submission mode for extraction runs
+
+Requests are rendered to JSONL shards (custom_id = document id), submitted
+as batches, polled, and the results joined back into the same prediction
+records that extract_to_jsonl writes, so clean_predictions works as is.
+Shards and submitted batch ids are saved in `work_dir` under a hash of the
+rendered requests, so polling resumes after a restart without resubmitting,
+while a run with different documents, model or prompt starts afresh.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from .async_extract import tool_kwargs, render_messages
+from .jsonl import JSONLWriter
+from .validation import get_validator
+
+logger = logging.getLogger(__name__)
+
+# Provider limits per batch input file
+MAX_REQUESTS = 50_000
+MAX_BYTES = 190 * 1024 ** 2
+
+ENDPOINT = '/v1/chat/completions'
+_DONE_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def render_batch_requests(texts, ids, model, messages, output_schema, **kwargs):
+    """ Yield one Batch API request line per document """
+    for _id, text in zip(ids, texts):
+        yield {
+            "custom_id": str(_id),
+            "method": "POST",
+            "url": ENDPOINT,
+            "body": {
+                "model": model,
+                "messages": render_messages(messages, text),
+                **tool_kwargs(output_schema),
+                **kwargs,
+            },
+        }
+
+
+def write_batch_files(requests, work_dir, name, max_requests=MAX_REQUESTS,
+                      max_bytes=MAX_BYTES):
+    """ Write requests to JSONL shards within the provider size limits """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    f, n_requests, n_bytes = None, 0, 0
+    for request in requests:
+        line = (json.dumps(request) + '\n').encode()
+        if f is None or n_requests >= max_requests \
+                or n_bytes + len(line) > max_bytes:
+            if f is not None:
+                f.close()
+            paths.append(work_dir / f'{name}_shard-{len(paths):04d}.jsonl')
+            f, n_requests, n_bytes = open(paths[-1], 'wb'), 0, 0
+        f.write(line)
+        n_requests += 1
+        n_bytes += len(line)
+    if f is not None:
+        f.close()
+    return paths
+
+
+def submit_batches(client, paths, completion_window='24h'):
+    """ Upload shards and create one batch per shard, returning batch ids """
+    batch_ids = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose='batch')
+        batch = client.batches.create(
+            input_file_id=input_file.id, endpoint=ENDPOINT,
+            completion_window=completion_window,
+            metadata={'shard': Path(path).name},
+        )
+        batch_ids.append(batch.id)
+    return batch_ids
+
+
+def wait_for_batches(client, batch_ids, poll_interval=60):
+    """ Poll until every batch reaches a final status """
+    pending = set(batch_ids)
+    batches = {}
+    while pending:
+        for batch_id in list(pending):
+            batch = client.batches.retrieve(batch_id)
+            if batch.status in _DONE_STATUSES:
+                batches[batch_id] = batch
+                pending.discard(batch_id)
+                if batch.status != 'completed':
+                    logger.warning(f"Batch {batch_id} {batch.status}")
+        if pending:
+            time.sleep(poll_interval)
+    return [batches[b] for b in batch_ids]
+
+
+def _iter_results(client, batches):
+    for batch in batches:
+        if not batch.output_file_id:
+            continue
+        content = client.files.content(batch.output_file_id).text
+        for line in content.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def _parse_result(result):
+    """ Prediction from one output line, or None if the request failed """
+    response = result.get('response') or {}
+    if result.get('error') or response.get('status_code') != 200:
+        return None
+    message = response['body']['choices'][0]['message']
+    tool_calls = message.get('tool_calls')
+    if not tool_calls:
+        return None
+    try:
+        return json.loads(tool_calls[0]['function']['arguments'])
+    except json.JSONDecodeError:
+        return None
+
+
+def _requests_key(requests):
+    """ Short hash of rendered requests, identifying a batch run """
+    sha = hashlib.sha1()
+    for request in requests:
+        sha.update(json.dumps(request, sort_keys=True).encode())
+    return sha.hexdigest()[:12]
+
+
+def batch_extract(texts, ids, output_path, client, model, messages,
+                  output_schema, work_dir, id_key='pmcid', meta=None,
+                  poll_interval=60, max_resubmits=1, **kwargs):
+    """ Extract through the Batch API, writing predictions to a JSONL file.
+
+    Args:
+        texts: iterable of texts
+        ids: unique ids (e.g. pmcids), aligned with texts
+        output_path: JSONL file for predictions, as written by
+            extract_to_jsonl
+        client: OpenAI client (base_url may point to a local fake server)
+        work_dir: directory for request shards and submitted batch ids
+        meta: optional list of dicts, aligned with texts, added to records
+        max_resubmits: times a failed, expired or cancelled batch is
+            resubmitted before giving up
+        kwargs: extra request arguments (e.g. temperature)
+    Returns:
+        number of predictions written
+    Raises:
+        RuntimeError: if a batch does not complete; the output file is
+            left untouched
+    """
+    ids = list(ids)
+    by_custom_id = {str(_id): _id for _id in ids}
+    if meta is not None:
+        meta = {str(_id): m for _id, m in zip(ids, meta)}
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    requests = list(render_batch_requests(
+        texts, ids, model, messages, output_schema, **kwargs))
+    # Shards and batches of other documents, models or prompts are not reused
+    name = f'{Path(output_path).stem}_{_requests_key(requests)}'
+    state_path = work_dir / f'{name}_batches.json'
+
+    # {shard name: batch id}, saved after every submission
+    state = {}
+    if state_path.exists():
+        state = json.loads(state_path.read_text())
+        logger.info(f"Resuming {len(state)} submitted batches")
+
+    paths = sorted(work_dir.glob(f'{name}_shard-*.jsonl'))
+    if not paths:
+        paths = write_batch_files(requests, work_dir, name)
+    del requests
+
+    def submit(path):
+        state[path.name] = submit_batches(client, [path])[0]
+        state_path.write_text(json.dumps(state))
+
+    for path in paths:
+        if path.name not in state:
+            submit(path)
+
+    for attempt in range(max_resubmits + 1):
+        batches = wait_for_batches(
+            client, [state[p.name] for p in paths], poll_interval)
+        unfinished = [path for path, batch in zip(paths, batches)
+                      if batch.status != 'completed']
+        if not unfinished:
+            break
+        if attempt == max_resubmits:
+            raise RuntimeError(
+                f"{len(unfinished)} batches did not complete: "
+                f"{[state[p.name] for p in unfinished]}")
+        for path in unfinished:
+            logger.warning(f"Resubmitting {path.name}")
+            submit(path)
+
+    # Repaired like streamed responses; unrecoverable ones are dropped
+    validator = get_validator(output_schema)
+
+    # Batch output is complete, so it replaces any previous file, once
+    # fully written
+    tmp_path = Path(f'{output_path}.tmp')
+    tmp_path.unlink(missing_ok=True)
+    n_written = 0
+    with JSONLWriter(tmp_path) as writer:
+        for result in _iter_results(client, batches):
+            pred = validator.repair_or_none(_parse_result(result))
+            if not pred:
+                continue
+            custom_id = result['custom_id']
+            record = {**pred, id_key: by_custom_id.get(custom_id, custom_id)}
+            if meta is not None:
+                record.update(meta.get(custom_id, {}))
+            writer.write(record)
+            n_written += 1
+    os.replace(tmp_path, output_path)
+    logger.info(f"Validation of batch responses: {validator.rates()}")
+    return n_written
@@ -0,0 +1,260 @@
+""" Batched BERTScore with a per-string embedding cache
+
+BERTScorer.score runs the model on both strings of every pair. Here each
+unique string is embedded once (in large batches, cached in memory and
+optionally on disk), and pairs are scored from the cached token
+embeddings with the same greedy cosine matching, idf weighting and
+baseline rescaling as bert_score.
+
+Pair scores are memoized too: a PairScoreCache keyed by (prediction,
+reference, scorer config) is shared across evaluation runs, so a new run
+only scores string pairs never seen before.
+"""
+import hashlib
+import logging
+import sqlite3
+from collections import Counter, defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """ Persistent token embeddings and idf weights of strings, per model
+
+    Args:
+        path: path to the SQLite file
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(str(path), timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, n_tokens INTEGER, dim INTEGER, "
+            "embedding BLOB, idf BLOB)"
+        )
+
+    def get_many(self, keys):
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self._conn.execute(
+                "SELECT key, n_tokens, dim, embedding, idf FROM embeddings "
+                f"WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, n_tokens, dim, embedding, idf in rows:
+                found[key] = (
+                    np.frombuffer(embedding, dtype=np.float32)
+                    .reshape(n_tokens, dim),
+                    np.frombuffer(idf, dtype=np.float32),
+                )
+        return found
+
+    def set_many(self, items):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                [(key, emb.shape[0], emb.shape[1],
+                  emb.astype(np.float32).tobytes(),
+                  idf.astype(np.float32).tobytes())
+                 for key, (emb, idf) in items.items()])
+
+    def close(self):
+        self._conn.close()
+
+
+class PairScoreCache:
+    """ Persistent (prediction, reference, config) -> (P, R, F1) scores
+
+    Args:
+        path: path to the SQLite file
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(str(path), timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "config TEXT, prediction TEXT, reference TEXT, "
+            "p REAL, r REAL, f1 REAL, "
+            "PRIMARY KEY (config, prediction, reference))"
+        )
+
+    def get_many(self, pairs, config):
+        """ {(prediction, reference): (p, r, f1)} of the cached pairs """
+        found = {}
+        pairs = list(pairs)
+        for i in range(0, len(pairs), 250):
+            chunk = pairs[i:i + 250]
+            condition = ' OR '.join(
+                ['(prediction = ? AND reference = ?)'] * len(chunk))
+            rows = self._conn.execute(
+                "SELECT prediction, reference, p, r, f1 FROM scores "
+                f"WHERE config = ? AND ({condition})",
+                [config, *(text for pair in chunk for text in pair)])
+            for prediction, reference, p, r, f1 in rows:
+                found[(prediction, reference)] = (p, r, f1)
+        return found
+
+    def set_many(self, scores, config):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                [(config, pred, ref, *score)
+                 for (pred, ref), score in scores.items()])
+
+    def close(self):
+        self._conn.close()
+
+
+class CachedBERTScorer:
+    """ Score many (candidate, reference) pairs, embedding each string once
+
+    Args:
+        scorer: bert_score.BERTScorer (model, layer, idf and baseline
+            settings are taken from it)
+        cache: optional EmbeddingCache, for embeddings across runs
+        pair_cache: optional PairScoreCache, for pair scores across runs
+        batch_size: strings per model forward pass
+        pair_batch_size: pairs scored per vectorized block
+    """
+
+    def __init__(self, scorer, cache=None, pair_cache=None, batch_size=128,
+                 pair_batch_size=4096):
+        self.scorer = scorer
+        self.cache = cache
+        self.pair_cache = pair_cache
+        self.stats = Counter()
+        self.batch_size = batch_size
+        self.pair_batch_size = pair_batch_size
+        self._embeddings = {}
+        self.config = '|'.join(map(str, (
+            scorer.model_type, scorer.num_layers, scorer.idf)))
+        # Pair scores also depend on the baseline rescaling
+        self.score_config = f'{self.config}|{scorer.rescale_with_baseline}'
+
+    def _key(self, text):
+        return hashlib.sha1(f'{self.config}|{text}'.encode()).hexdigest()
+
+    def _idf_dict(self):
+        if self.scorer.idf:
+            return self.scorer._idf_dict
+        tokenizer = self.scorer._tokenizer
+        idf_dict = defaultdict(lambda: 1.0)
+        idf_dict[tokenizer.sep_token_id] = 0
+        idf_dict[tokenizer.cls_token_id] = 0
+        return idf_dict
+
+    def _embed_batch(self, texts):
+        import torch
+        from bert_score.utils import get_bert_embedding
+
+        with torch.no_grad():
+            embedding, mask, idf = get_bert_embedding(
+                texts, self.scorer._model, self.scorer._tokenizer,
+                self._idf_dict(), batch_size=self.batch_size,
+                device=self.scorer.device)
+        embedding = embedding / torch.norm(embedding, dim=-1, keepdim=True)
+        lengths = mask.sum(dim=1).tolist()
+        embedding, idf = embedding.cpu().numpy(), idf.cpu().numpy()
+        return {
+            text: (embedding[i, :n].astype(np.float32),
+                   idf[i, :n].astype(np.float32))
+            for i, (text, n) in enumerate(zip(texts, lengths))
+        }
+
+    def embed(self, texts):
+        """ Make sure all texts have cached token embeddings """
+        missing = [t for t in dict.fromkeys(texts) if t not in self._embeddings]
+        if missing and self.cache is not None:
+            keys = {self._key(t): t for t in missing}
+            for key, value in self.cache.get_many(list(keys)).items():
+                self._embeddings[keys[key]] = value
+            missing = [t for t in missing if t not in self._embeddings]
+
+        # Similar lengths in a batch keep padding low
+        missing.sort(key=len)
+        for start in range(0, len(missing), self.batch_size * 8):
+            embedded = self._embed_batch(
+                missing[start:start + self.batch_size * 8])
+            self._embeddings.update(embedded)
+            if self.cache is not None:
+                self.cache.set_many(
+                    {self._key(t): v for t, v in embedded.items()})
+
+    def _padded(self, texts):
+        """ (n, max_tokens, dim) embeddings and (n, max_tokens) idf weights,
+        normalized to sum to one """
+        items = [self._embeddings[t] for t in texts]
+        max_tokens = max(e.shape[0] for e, _ in items)
+        dim = items[0][0].shape[1]
+        embedding = np.zeros((len(items), max_tokens, dim), dtype=np.float32)
+        idf = np.zeros((len(items), max_tokens), dtype=np.float32)
+        mask = np.zeros((len(items), max_tokens), dtype=bool)
+        for i, (e, w) in enumerate(items):
+            embedding[i, :len(e)] = e
+            idf[i, :len(w)] = w
+            mask[i, :len(e)] = True
+        idf /= idf.sum(axis=1, keepdims=True)
+        return embedding, idf, mask
+
+    def score(self, candidates, references):
+        """ P, R and F1 arrays for aligned candidate and reference strings """
+        self.embed(list(candidates) + list(references))
+        n = len(candidates)
+        scores = np.zeros((3, n), dtype=np.float32)
+
+        for start in range(0, n, self.pair_batch_size):
+            stop = min(start + self.pair_batch_size, n)
+            cand, cand_idf, cand_mask = self._padded(candidates[start:stop])
+            ref, ref_idf, ref_mask = self._padded(references[start:stop])
+
+            # Padding never wins the max (cosine similarities are >= -1),
+            # so scores do not depend on which pairs share a block
+            sim = np.einsum('nid,njd->nij', cand, ref)
+            sim[~(cand_mask[:, :, None] & ref_mask[:, None, :])] = -2
+
+            precision = (sim.max(axis=2) * cand_idf).sum(axis=1)
+            recall = (sim.max(axis=1) * ref_idf).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                f1 = 2 * precision * recall / (precision + recall)
+            scores[:, start:stop] = precision, recall, np.nan_to_num(f1)
+
+        if self.scorer.rescale_with_baseline:
+            baseline = np.asarray(
+                self.scorer.baseline_vals.cpu(), dtype=np.float32)[:, None]
+            scores = (scores - baseline) / (1 - baseline)
+        return scores[0], scores[1], scores[2]
+
+    def score_pairs(self, pairs):
+        """ {(candidate, reference): (P, R, F1)} for unique pairs; only pairs
+        missing from the pair cache are scored """
+        pairs = list(dict.fromkeys(pairs))
+        found = {}
+        if self.pair_cache is not None:
+            found = self.pair_cache.get_many(pairs, self.score_config)
+        missing = [pair for pair in pairs if pair not in found]
+        self.stats['hits'] += len(pairs) - len(missing)
+        self.stats['misses'] += len(missing)
+
+        if missing:
+            candidates, references = zip(*missing)
+            p, r, f1 = self.score(list(candidates), list(references))
+            scored = {
+                pair: (float(p[i]), float(r[i]), float(f1[i]))
+                for i, pair in enumerate(missing)
+            }
+            if self.pair_cache is not None:
+                self.pair_cache.set_many(scored, self.score_config)
+            found.update(scored)
+
+        logger.info(
+            f"Scored {len(missing)} of {len(pairs)} pairs "
+            f"(pair cache hit rate {self.hit_rate():.1%})")
+        return {pair: found[pair] for pair in pairs}
+
+    def hit_rate(self):
+        """ Share of requested pairs served by the pair cache """
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
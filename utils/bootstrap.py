@@ -0,0 +1,127 @@
+""" Vectorized paper-level bootstrap of evaluation metrics
+
+Metrics are reduced once to per-paper sums and counts (e.g. summed
+percentage errors and the number of papers compared, or summed F1 and the
+number of matched pairs). Each replicate resamples papers with
+replacement; an index matrix of replicates x papers is turned into a
+matrix of paper weights, and all replicates of all metrics are one
+matrix product: (weights @ sums) / (weights @ counts).
+
+Runs evaluated with the same weights (the same seed and paper universe)
+are paired, so differences between their replicates give CIs of
+differences between runs.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+NUMERIC_COLUMNS = [
+    'count', 'male_count', 'female_count', 'age_mean', 'age_minimum',
+    'age_maximum', 'age_median']
+
+
+def bootstrap_weights(n_papers, n_boot=2000, seed=0):
+    """ (n_boot, n_papers) matrix of how often each paper is drawn """
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, n_papers, size=(n_boot, n_papers))
+    offsets = np.arange(n_boot)[:, None] * n_papers
+    return np.bincount(
+        (indices + offsets).ravel(), minlength=n_boot * n_papers
+    ).reshape(n_boot, n_papers).astype(np.float64)
+
+
+def ratio_replicates(sums, counts, weights):
+    """ Bootstrap replicates of sum(sums) / sum(counts)
+
+    Args:
+        sums, counts: (n_papers,) or (n_papers, n_metrics) arrays
+        weights: bootstrap_weights matrix
+    Returns:
+        (n_boot,) or (n_boot, n_metrics) replicates (NaN if no paper of a
+        replicate has a count)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (weights @ sums) / (weights @ counts)
+
+
+def confidence_interval(replicates, alpha=0.05):
+    """ Percentile interval (low, high) over the replicate axis """
+    with warnings.catch_warnings():
+        # Metrics without any compared paper have all-NaN replicates
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(
+            replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+
+def percentage_errors(annotations, predictions, papers,
+                      columns=NUMERIC_COLUMNS):
+    """ Per-paper absolute percentage error of the mean group value of each
+    column (as in avg_mean_percentage_error)
+
+    Returns:
+        (sums, counts) arrays of shape (n_papers, n_columns), aligned to
+        `papers` (papers that cannot be compared have a zero count), and
+        the compared columns
+    """
+    columns = [c for c in columns
+               if c in annotations.columns and c in predictions.columns]
+    annotated = annotations.groupby('pmcid')[columns].mean()
+    predicted = predictions.groupby('pmcid')[columns].mean()
+    annotated = annotated.reindex(papers)
+    predicted = predicted.reindex(papers)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        errors = ((predicted - annotated).abs() / annotated.abs()).to_numpy()
+    errors[~np.isfinite(errors)] = np.nan
+    valid = ~np.isnan(errors)
+    return np.where(valid, errors, 0.0), valid.astype(np.float64), columns
+
+
+def group_count_matches(annotations, predictions, papers):
+    """ Per-paper (correct number of groups, paper compared) arrays.
+
+    Papers without annotations count as compared and incorrect, papers
+    without predictions are not compared, as in evaluate_predictions.
+    """
+    predicted = predictions.groupby('pmcid').size().reindex(papers)
+    annotated = annotations.groupby('pmcid').size().reindex(papers)
+    compared = predicted.notna().to_numpy()
+    correct = (annotated == predicted).to_numpy() & compared
+    return correct.astype(np.float64), compared.astype(np.float64)
+
+
+def score_sums(all_scores, papers, column='f1'):
+    """ Per-paper (summed score, number of scored pairs) arrays of matched
+    pair records, e.g. BERTScore matches """
+    scores = pd.DataFrame(all_scores)
+    scores = scores[pd.to_numeric(scores[column], errors='coerce').notna()]
+    grouped = scores.groupby('pmcid')[column]
+    sums = grouped.sum().astype(float).reindex(papers, fill_value=0.0)
+    counts = grouped.size().astype(float).reindex(papers, fill_value=0.0)
+    return sums.to_numpy(), counts.to_numpy()
+
+
+def bootstrap_table(metrics, weights, alpha=0.05):
+    """ Point estimates and CIs of several metrics
+
+    Args:
+        metrics: {(metric, variable): (sums, counts)} per-paper arrays
+        weights: bootstrap_weights matrix
+    Returns:
+        DataFrame with metric, variable, estimate, ci_low and ci_high
+    """
+    keys = list(metrics)
+    sums = np.column_stack([metrics[k][0] for k in keys])
+    counts = np.column_stack([metrics[k][1] for k in keys])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estimate = sums.sum(axis=0) / counts.sum(axis=0)
+    low, high = confidence_interval(
+        ratio_replicates(sums, counts, weights), alpha)
+    return pd.DataFrame({
+        'metric': [k[0] for k in keys],
+        'variable': [k[1] for k in keys],
+        'estimate': estimate,
+        'ci_low': low,
+        'ci_high': high,
+    })
@@ -0,0 +1,99 @@
+""" Content-addressed on-disk cache for LLM extraction calls """
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def request_key(model, messages, output_schema, **kwargs):
+    """ Hash of everything that determines an extraction response """
+    payload = json.dumps({
+        'model': model,
+        'messages': messages,
+        'output_schema': output_schema,
+        'kwargs': kwargs,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ExtractionCache:
+    """ Persistent response cache with least-recently-used eviction.
+
+    Responses are stored in a SQLite file as soon as they arrive, so an
+    interrupted run can be replayed without new API calls.
+
+    Args:
+        path: path to the SQLite file
+        max_bytes: evict least recently used entries above this total size
+    """
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_accessed ON responses (accessed)")
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        row = self._conn.execute(
+            "SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._conn:
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?",
+                (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        size = len(value)
+        with self._conn:
+            old = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()))
+        self._size += size - (old[0] if old else 0)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # Drop oldest entries until under 90% of the budget
+        target = 0.9 * self.max_bytes
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed")
+        evict = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evict.append((key,))
+            self._size -= size
+        rows.close()
+        with self._conn:
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", evict)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hit_rate, 'bytes': self._size,
+        }
+
+    def close(self):
+        self._conn.close()
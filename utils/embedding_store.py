@@ -0,0 +1,151 @@
+""" Shared, deduplicated chunk-embedding store
+
+Vectors are keyed by a hash of the embedding model and the chunk text, so
+any chunking configuration reuses vectors for chunks it has seen before.
+"""
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from publang.utils.split import split_pmc_document
+
+
+def text_key(text, model):
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingStore:
+    """ Append-only float32 matrix, memory-mapped, with a key -> row index.
+
+    Layout in `directory`:
+        vectors.f32: row-major float32 matrix of shape (n, dim)
+        keys.txt: one key per line, line number is the row
+
+    Args:
+        directory: where the store lives (created if missing)
+        dim: embedding dimension (1536 for text-embedding-ada-002)
+    """
+
+    def __init__(self, directory, dim=1536):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self._vectors_path = self.directory / 'vectors.f32'
+        self._keys_path = self.directory / 'keys.txt'
+        self._load()
+
+    def _load(self):
+        keys = []
+        if self._keys_path.exists():
+            keys = self._keys_path.read_text().split()
+        n_vectors = 0
+        if self._vectors_path.exists():
+            n_vectors = os.path.getsize(self._vectors_path) // (4 * self.dim)
+
+        # Vectors are written before keys, so only keys can be missing
+        # after an interrupted write
+        n = min(len(keys), n_vectors)
+        self.index = {k: i for i, k in enumerate(keys[:n])}
+        if n_vectors > n or len(keys) > n:
+            self._truncate(keys[:n], n)
+        self._map()
+
+    def _map(self):
+        n = len(self.index)
+        self.vectors = (
+            np.memmap(self._vectors_path, dtype=np.float32, mode='r',
+                      shape=(n, self.dim))
+            if n else np.empty((0, self.dim), dtype=np.float32)
+        )
+
+    def _truncate(self, keys, n):
+        with open(self._vectors_path, 'r+b') as f:
+            f.truncate(n * self.dim * 4)
+        self._keys_path.write_text(''.join(k + '\n' for k in keys))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def rows(self, keys):
+        """ Row of each key, -1 if missing """
+        return np.array([self.index.get(k, -1) for k in keys], dtype=np.int64)
+
+    def add(self, keys, vectors):
+        """ Append vectors for keys not yet in the store """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        new = [i for i, k in enumerate(keys) if k not in self.index]
+        # Drop duplicates within the batch
+        new = list({keys[i]: i for i in new}.values())
+        if not new:
+            return
+        with open(self._vectors_path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors[new]).tobytes())
+        with open(self._keys_path, 'a') as f:
+            f.write(''.join(keys[i] + '\n' for i in new))
+        for i in new:
+            self.index[keys[i]] = len(self.index)
+        self._map()
+
+    def get(self, keys):
+        """ (n, dim) matrix for keys, all of which must be in the store """
+        rows = self.rows(keys)
+        if (rows < 0).any():
+            raise KeyError(f"{(rows < 0).sum()} keys missing from store")
+        return self.vectors[rows]
+
+
+def embed_texts(texts, store, client, model, batch_size=1000):
+    """ Embed texts, calling the API only for text not already in the store.
+
+    Returns:
+        array of store rows, aligned with texts
+    """
+    keys = [text_key(t, model) for t in texts]
+    missing = {}
+    for k, t in zip(keys, texts):
+        if k not in store and k not in missing:
+            missing[k] = t
+
+    missing = list(missing.items())
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        response = client.embeddings.create(
+            model=model, input=[t for _, t in batch])
+        store.add(
+            [k for k, _ in batch], [d.embedding for d in response.data])
+
+    return store.rows(keys)
+
+
+def chunk_articles(articles, min_chars, max_chars):
+    """ Split articles into chunks.
+
+    Args:
+        articles: list of dicts with 'pmcid' and 'text'
+    Returns:
+        DataFrame with one row per chunk
+    """
+    chunks = []
+    for article in articles:
+        for chunk in split_pmc_document(
+                article['text'], min_chars=min_chars, max_chars=max_chars):
+            chunks.append({'pmcid': article['pmcid'], **chunk})
+    return pd.DataFrame(chunks)
+
+
+def chunk_embeddings(articles, store, client, model, min_chars, max_chars):
+    """ Split articles into chunks and attach embeddings from the store.
+
+    Returns:
+        DataFrame with one row per chunk, its store `row` and `embedding`
+    """
+    chunks = chunk_articles(articles, min_chars, max_chars)
+    chunks['row'] = embed_texts(
+        chunks['content'].to_list(), store, client, model)
+    chunks['embedding'] = list(store.vectors[chunks['row'].to_numpy()])
+    return chunks
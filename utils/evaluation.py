@@ -0,0 +1,95 @@
+""" Evaluation of demographics predictions against annotations
+
+Functions are module-level so evaluation drivers can run them in worker
+processes, one run (model, task and chunking config) per task.
+"""
+import pandas as pd
+from publang.evaluate import score_columns, hungarian_match_compare
+
+from .filters import filter_groups
+from .prediction_store import PARTITION_COLUMNS
+
+
+def run_predictions(predictions):
+    """ Predictions of one run, as read from the PredictionStore """
+    # Drop run metadata, and columns that only other runs have
+    predictions = predictions.drop(
+        columns=[c for c in PARTITION_COLUMNS if c in predictions.columns])
+    return predictions.dropna(axis=1, how='all').reset_index(drop=True)
+
+
+def evaluate_predictions(annotations, predictions):
+    """ Group matching and column errors of predictions
+
+    Returns:
+        n_studies, fraction of studies with the correct number of groups,
+        with more groups, with less groups, and a dict of stats
+    """
+    # Overall recall
+    # Print both fraction and percentage
+    n_studies = len(set(predictions.pmcid.unique()))
+
+    # Subset to only include mri participant groups
+    predictions = filter_groups(predictions)
+
+    # Subset to only pmcids in predictions
+    annotations = annotations[annotations.pmcid.isin(predictions.pmcid.unique())]
+
+    # Match compare
+    match_compare = hungarian_match_compare(annotations, predictions)
+
+    # Compare by columns (matched accuracy)
+    res_mean, res_sums, counts = score_columns(annotations, predictions)
+
+    # Compute overlap of pmcids
+    pred_n_groups = predictions.groupby('pmcid').size()
+    n_groups = annotations.groupby('pmcid').size()
+    correct_n_groups = (n_groups == pred_n_groups)
+    more_groups_pred = (n_groups < pred_n_groups)
+    less_groups_pred = (n_groups > pred_n_groups)
+
+    combined_stats = {
+        "hungarian_matched_error": match_compare,
+        "counts": counts,
+        "avg_mean_percentage_error": res_mean,
+        "summed_mean_percentage_error": res_sums,
+    }
+
+    return (
+        n_studies, correct_n_groups.mean(), more_groups_pred.mean(),
+        less_groups_pred.mean(), combined_stats
+    )
+
+
+def evaluate_run(annotations, predictions, subsets=None):
+    """ Stats table of one run, for each subset of its papers
+
+    Args:
+        annotations: annotated groups
+        predictions: predictions of one run, as read from the store
+        subsets: {subset name: pmcids to evaluate on, or None for all}
+    Returns:
+        DataFrame with one row per variable and subset
+    """
+    predictions = run_predictions(predictions)
+    subsets = subsets or {'full': None}
+
+    results = []
+    for subset, pmcids in subsets.items():
+        subset_predictions = predictions
+        if pmcids is not None:
+            subset_predictions = predictions[predictions.pmcid.isin(pmcids)]
+
+        n_studies, corr_n_groups, more, less, stats = evaluate_predictions(
+            annotations, subset_predictions)
+
+        stats = pd.DataFrame(stats).reset_index()
+        stats = stats.rename(columns={'index': 'variable'})
+        stats['n_studies'] = n_studies
+        stats['corr_groups'] = corr_n_groups
+        stats['more_groups'] = more
+        stats['less_groups'] = less
+        stats['subset'] = subset
+        results.append(stats)
+
+    return pd.concat(results, ignore_index=True)
@@ -0,0 +1,33 @@
+""" Vectorized selection of the participant groups used for evaluation
+
+Rules, applied per paper (pmcid) with groupby transforms and boolean masks:
+
+- if a paper has several distinct imaging_sample values, its groups with
+  imaging_sample == 'no' are dropped
+- groups with assessment_type == 'behavioral' are dropped (the schema
+  field is spelled assesment_type; either column is used)
+"""
+ASSESSMENT_COLUMNS = ['assessment_type', 'assesment_type']
+
+
+def imaging_mask(predictions):
+    """ False for non-imaging groups of papers that have other groups """
+    n_values = predictions.groupby('pmcid')['imaging_sample'].transform(
+        'nunique', dropna=False)
+    return (n_values <= 1) | (predictions['imaging_sample'] != 'no')
+
+
+def filter_groups(predictions):
+    """ Groups of imaging samples, excluding behavioral-only groups
+
+    Rows are ordered by pmcid (stable) with a fresh index, and rows without
+    a pmcid are dropped, as the per-paper groupby-apply filter did.
+    """
+    keep = predictions['pmcid'].notna()
+    if 'imaging_sample' in predictions.columns:
+        keep &= imaging_mask(predictions)
+    for column in ASSESSMENT_COLUMNS:
+        if column in predictions.columns:
+            keep &= predictions[column] != 'behavioral'
+    return predictions[keep].sort_values(
+        'pmcid', kind='stable').reset_index(drop=True)
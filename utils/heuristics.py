@@ -1,5 +1,8 @@
 import re
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 _PARTICIPANTS_SECTIONS = (
     r"(?:participants?|subjects?|patients|population|demographics?|design|procedure)"
@@ -9,21 +12,62 @@ _METHODS_SECTIONS = (
     r"methods?|materials?|design?|case|procedures?"
 )
 
+_METHODS_RE = re.compile(_METHODS_SECTIONS, re.IGNORECASE)
+_PARTICIPANTS_RE = re.compile(_PARTICIPANTS_SECTIONS, re.IGNORECASE)
+
+
+def _matches(column, pattern):
+    """ Boolean array, True where column matches pattern (missing is False) """
+    if isinstance(column, (pa.Array, pa.ChunkedArray)):
+        matched = pc.match_substring_regex(
+            column, pattern.pattern, ignore_case=True)
+        return pc.fill_null(matched, False).to_numpy(zero_copy_only=False)
+    return column.str.contains(
+        pattern.pattern, case=False, na=False, regex=True
+    ).to_numpy(dtype=bool)
+
+
+def _group_any(mask, codes, n_groups):
+    """ Broadcast per-group any() of mask back to rows """
+    return (np.bincount(codes, weights=mask, minlength=n_groups) > 0)[codes]
+
+
 def get_chunks_heuristic(embeddings_df, section_2=True):
-    """ if fallback=True, returns all if one step fails """
-    results = []
-    for _, sub_df in embeddings_df.groupby('pmcid', sort=False):
-        # Try getting Methods section
-        m_ix = sub_df.section_1.apply(
-            lambda x: bool(re.search(_METHODS_SECTIONS, x,  re.IGNORECASE)) if not pd.isna(x) else False)
-
-        if m_ix.sum() != 0:
-            sub_df = sub_df[m_ix]
-
-            # Try getting design section
-            d_ix = sub_df.section_2.apply(
-                lambda x: bool(re.search(_PARTICIPANTS_SECTIONS, x,  re.IGNORECASE)) if not pd.isna(x) else False)
-            if section_2 and d_ix.sum() > 0:
-                sub_df = sub_df[d_ix]
-        results.append(sub_df)
-    
\ No newline at end of file
+    """ Keep chunks in Methods sections, and within those in participant sections.
+
+    Each step falls back to all of the article's chunks if nothing matches.
+
+    Args:
+        embeddings_df: chunks DataFrame (numpy or Arrow-backed) or
+            pyarrow Table, with pmcid, section_1 and section_2 columns
+        section_2: also filter on participant sections
+    Returns:
+        the selected rows, grouped by pmcid in order of first appearance
+    """
+    is_table = isinstance(embeddings_df, pa.Table)
+    pmcid = embeddings_df['pmcid']
+    codes, uniques = pd.factorize(
+        np.asarray(pmcid) if is_table else pmcid.to_numpy())
+    # Rows with a missing pmcid get their own group, and are dropped
+    missing = codes < 0
+    n_groups = len(uniques) + 1
+    codes[missing] = len(uniques)
+
+    # Try getting Methods section
+    m_ix = _matches(embeddings_df['section_1'], _METHODS_RE)
+    has_m = _group_any(m_ix, codes, n_groups)
+    keep = m_ix | ~has_m
+
+    # Try getting design section, within Methods
+    if section_2:
+        d_ix = _matches(embeddings_df['section_2'], _PARTICIPANTS_RE) & m_ix
+        has_d = _group_any(d_ix, codes, n_groups)
+        keep &= d_ix | ~has_d
+
+    # Stable sort keeps row order within each pmcid
+    rows = np.flatnonzero(keep & ~missing)
+    rows = rows[np.argsort(codes[rows], kind='stable')]
+
+    if is_table:
+        return embeddings_df.take(rows)
+    return embeddings_df.iloc[rows]
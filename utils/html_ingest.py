@@ -0,0 +1,155 @@
+""" Parallel, incremental HTML corpus ingestion
+
+Parsed text is written in batches to parquet parts under `output_dir`,
+together with a manifest of the source files. On re-runs only new or
+changed files (by size/mtime, then content hash) are parsed again.
+"""
+import hashlib
+import json
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bs4 import BeautifulSoup
+
+_SCHEMA = pa.schema([
+    ('text', pa.string()),
+    ('pmid', pa.string()),
+    ('pmcid', pa.int64()),
+    ('complete', pa.bool_()),
+    ('path', pa.string()),
+])
+
+
+def _file_hash(path):
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()
+
+
+def _parse(path):
+    """ Extract body text and pmid (from the filename) of one HTML file """
+    html = Path(path).read_text()
+    body_text = BeautifulSoup(html, 'lxml').get_text()
+    return {
+        'text': body_text,
+        'pmid': Path(path).stem,
+        'complete': len(body_text) > 1000,
+        'path': str(path),
+    }
+
+
+def _load_manifest(output_dir):
+    manifest_path = Path(output_dir) / 'manifest.json'
+    if manifest_path.exists():
+        return json.loads(manifest_path.read_text())
+    return {}
+
+
+def _save_manifest(output_dir, manifest):
+    manifest_path = Path(output_dir) / 'manifest.json'
+    tmp_path = manifest_path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(manifest))
+    tmp_path.replace(manifest_path)
+
+
+def _changed_files(files, manifest):
+    """ Files that are new, or whose content changed since the manifest """
+    changed = []
+    for f in files:
+        stat = f.stat()
+        entry = manifest.get(str(f))
+        if entry and entry['size'] == stat.st_size \
+                and entry['mtime'] == stat.st_mtime:
+            continue
+        sha1 = _file_hash(f)
+        if entry and entry['sha1'] == sha1:
+            entry['mtime'] = stat.st_mtime
+            continue
+        changed.append((f, stat, sha1))
+    return changed
+
+
+def ingest_html(html_files, output_dir, resolve_pmcids=None, n_workers=None,
+                batch_size=1000):
+    """ Parse new or changed HTML files and append them as parquet parts.
+
+    Args:
+        html_files: iterable of HTML paths (e.g. Path(...).glob('*/*.html'))
+        output_dir: directory holding parquet parts and manifest.json
+        resolve_pmcids: optional callable, list of pmids -> {pmid: pmcid},
+            with pmcids without the 'PMC' prefix
+        n_workers: number of parser processes (default: all cores)
+        batch_size: number of documents per parquet part
+    Returns:
+        number of files parsed
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = _load_manifest(output_dir)
+
+    html_files = [Path(f) for f in html_files]
+    changed = _changed_files(html_files, manifest)
+
+    # Forget files that were removed from disk
+    present = {str(f) for f in html_files}
+    for path in list(manifest):
+        if path not in present:
+            del manifest[path]
+
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    with ProcessPoolExecutor(n_workers) as executor:
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start:start + batch_size]
+            records = list(executor.map(
+                _parse, [f for f, _, _ in batch], chunksize=16))
+
+            pmcids = {}
+            if resolve_pmcids is not None:
+                pmcids = resolve_pmcids([r['pmid'] for r in records])
+            for r in records:
+                pmcid = pmcids.get(r['pmid'])
+                r['pmcid'] = int(pmcid) if pmcid else None
+
+            part = f'part-{run_id}-{start // batch_size:05d}.parquet'
+            pq.write_table(
+                pa.Table.from_pylist(records, schema=_SCHEMA),
+                output_dir / part)
+
+            for f, stat, sha1 in batch:
+                manifest[str(f)] = {
+                    'size': stat.st_size, 'mtime': stat.st_mtime,
+                    'sha1': sha1, 'part': part,
+                }
+            # Save after every part, so an interrupted run keeps its progress
+            _save_manifest(output_dir, manifest)
+
+    _save_manifest(output_dir, manifest)
+    return len(changed)
+
+
+def load_html_corpus(output_dir, columns=None):
+    """ Load the current version of every ingested document.
+
+    Rows from parts that were superseded (changed or removed files) are
+    dropped using the manifest.
+    """
+    output_dir = Path(output_dir)
+    manifest = _load_manifest(output_dir)
+    parts = sorted({entry['part'] for entry in manifest.values()})
+
+    read_columns = None if columns is None else list(set(columns) | {'path'})
+    docs = []
+    for part in parts:
+        df = pd.read_parquet(output_dir / part, columns=read_columns)
+        current = df['path'].map(lambda p: manifest.get(p, {}).get('part'))
+        docs.append(df[current == part])
+
+    if not docs:
+        return pd.DataFrame(columns=_SCHEMA.names)
+    docs = pd.concat(docs, ignore_index=True)
+    if columns is not None:
+        docs = docs[columns]
+    return docs
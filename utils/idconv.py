@@ -0,0 +1,152 @@
+""" Cached, concurrent PMID -> PMCID resolver
+
+The resolver keeps every answer in a local SQLite mapping, and only sends
+unknown PMIDs to its backend. Backends are plain callables taking a list of
+PMIDs and returning {pmid: pmcid or None}, so the NCBI service can be
+swapped for a local mock server or an offline mapping file.
+"""
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+NCBI_IDCONV_URL = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
+
+
+def _strip_pmc(pmcid):
+    if pmcid is None:
+        return None
+    return pmcid[3:] if pmcid.upper().startswith('PMC') else pmcid
+
+
+class IDConvBackend:
+    """ NCBI ID converter API (or any server speaking the same XML).
+
+    Args:
+        base_url: idconv endpoint, e.g. a local mock server in tests
+        max_concurrency: size of the connection pool
+        max_retries: retries on connection errors and 429/5xx responses,
+            with exponential backoff
+        tool, email: identify the client to NCBI, as they request
+    """
+
+    def __init__(self, base_url=NCBI_IDCONV_URL, max_concurrency=3,
+                 max_retries=5, backoff_factor=0.5, tool=None, email=None,
+                 timeout=30):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.params = {k: v for k, v in
+                       {'tool': tool, 'email': email}.items() if v}
+
+        retry = Retry(
+            total=max_retries, backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=max_concurrency, pool_maxsize=max_concurrency,
+            max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __call__(self, pmids):
+        response = self.session.get(
+            self.base_url, params={'ids': ','.join(pmids), **self.params},
+            timeout=self.timeout)
+        response.raise_for_status()
+
+        # <record requested-id="23193288" pmcid="PMC3531191" pmid="23193288" ...>
+        # doi and pmcid are absent for some records
+        found = {}
+        for record in ET.fromstring(response.content).iter('record'):
+            pmid = record.get('pmid') or record.get('requested-id')
+            found[pmid] = _strip_pmc(record.get('pmcid'))
+        return {p: found.get(p) for p in pmids}
+
+
+class MappingFileBackend:
+    """ Offline backend reading a CSV with pmid and pmcid columns """
+
+    def __init__(self, path):
+        # Empty pmcid cells (PMIDs without a PMCID) are kept as ''
+        mapping = pd.read_csv(path, dtype=str, keep_default_na=False)
+        self.mapping = {
+            pmid.strip(): pmcid.strip() or None
+            for pmid, pmcid in zip(mapping['pmid'], mapping['pmcid'])
+        }
+
+    def __call__(self, pmids):
+        return {p: _strip_pmc(self.mapping.get(p)) for p in pmids}
+
+
+class PMCIDResolver:
+    """ Resolve PMIDs to PMCIDs, through a persistent local mapping.
+
+    Args:
+        backend: callable, list of pmids -> {pmid: pmcid or None}
+        cache_path: SQLite file holding resolved ids
+        batch_size: ids per backend request (NCBI accepts up to 200)
+        max_concurrency: concurrent backend requests
+        negative_ttl: seconds before a PMID without a PMCID is asked again
+    """
+
+    def __init__(self, backend, cache_path, batch_size=200, max_concurrency=3,
+                 negative_ttl=30 * 24 * 3600):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.negative_ttl = negative_ttl
+        self._conn = sqlite3.connect(str(cache_path))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS idmap ("
+            "pmid TEXT PRIMARY KEY, pmcid TEXT, resolved REAL)"
+        )
+
+    def _cached(self, pmids):
+        cached = {}
+        cutoff = time.time() - self.negative_ttl
+        for i in range(0, len(pmids), 500):
+            chunk = pmids[i:i + 500]
+            rows = self._conn.execute(
+                "SELECT pmid, pmcid, resolved FROM idmap WHERE pmid IN "
+                f"({','.join('?' * len(chunk))})", chunk)
+            for pmid, pmcid, resolved in rows:
+                if pmcid is not None or resolved > cutoff:
+                    cached[pmid] = pmcid
+        return cached
+
+    def _store(self, mapping):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO idmap VALUES (?, ?, ?)",
+                [(p, pmc, now) for p, pmc in mapping.items()])
+
+    def resolve(self, pmids):
+        """ {pmid: pmcid} (without 'PMC' prefix) for PMIDs that have one """
+        pmids = list(dict.fromkeys(str(p) for p in pmids))
+        mapping = self._cached(pmids)
+
+        missing = [p for p in pmids if p not in mapping]
+        batches = [missing[i:i + self.batch_size]
+                   for i in range(0, len(missing), self.batch_size)]
+
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            futures = [executor.submit(self.backend, b) for b in batches]
+            for future in as_completed(futures):
+                result = future.result()
+                self._store(result)
+                mapping.update(result)
+
+        return {p: pmc for p, pmc in mapping.items() if pmc is not None}
+
+    __call__ = resolve
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,68 @@
+""" Append-only JSONL output for streaming, resumable extraction runs """
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _default(obj):
+    # numpy scalars (e.g. pmcids taken from a DataFrame)
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def read_jsonl(path):
+    """ Lazily yield records from a JSONL file.
+
+    A truncated last line (e.g. from a run killed mid-write) is skipped.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed line in {path}")
+
+
+def completed_ids(path, id_key='pmcid', retry_failed=False):
+    """ Set of ids that already have a record in `path`
+
+    Args:
+        retry_failed: leave out ids whose only records are failure markers
+            ({id_key: ..., "error": "failed"}), so they are extracted again
+    """
+    try:
+        return {r[id_key] for r in read_jsonl(path)
+                if id_key in r
+                and not (retry_failed and r.get('error') == 'failed')}
+    except FileNotFoundError:
+        return set()
+
+
+class JSONLWriter:
+    """ Append records to a JSONL file, flushing after every record """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'a+')
+        # Terminate a truncated last line before appending
+        if self._f.tell() > 0:
+            self._f.seek(self._f.tell() - 1)
+            if self._f.read(1) != '\n':
+                self._f.write('\n')
+
+    def write(self, record):
+        self._f.write(json.dumps(record, default=_default) + '\n')
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,118 @@
+""" Matching of predicted to annotated groups on pairwise score matrices
+
+For each pmcid, the scores of all (prediction, annotation) pairs form a
+(n_predictions, n_annotations) NumPy matrix. Groups are then matched either
+greedily (highest score first, as the original evaluator did) or optimally
+(Hungarian assignment maximizing the summed score).
+"""
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Score of pairs with a missing value; matched last, reported as NaN
+MISSING_SCORE = -1
+
+
+def greedy_assignment(scores):
+    """ Repeatedly match the highest scoring pair of unmatched rows and
+    columns. Ties go to the first pair in row-major order.
+
+    Returns:
+        (rows, cols) index arrays, in matching order
+    """
+    scores = np.array(scores, dtype=float)
+    rows, cols = [], []
+    for _ in range(min(scores.shape)):
+        row, col = np.unravel_index(np.argmax(scores), scores.shape)
+        rows.append(row)
+        cols.append(col)
+        scores[row, :] = -np.inf
+        scores[:, col] = -np.inf
+    return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+
+def optimal_assignment(scores):
+    """ Matching maximizing the summed score (Hungarian algorithm)
+
+    Returns:
+        (rows, cols) index arrays, highest scoring pair first
+    """
+    rows, cols = linear_sum_assignment(scores, maximize=True)
+    order = np.argsort(-scores[rows, cols], kind='stable')
+    return rows[order], cols[order]
+
+
+ASSIGNMENTS = {
+    'greedy': greedy_assignment,
+    'optimal': optimal_assignment,
+}
+
+
+def pair_frame(annotations, predictions, column='diagnosis'):
+    """ All (prediction, annotation) pairs within each pmcid, with the
+    position of each group within its pmcid (cand_ix, ref_ix) """
+    predictions = predictions[['pmcid', column]].assign(
+        cand_ix=predictions.groupby('pmcid').cumcount().to_numpy())
+    annotations = annotations[['pmcid', column]].assign(
+        ref_ix=annotations.groupby('pmcid').cumcount().to_numpy())
+    pairs = predictions.merge(
+        annotations, on='pmcid', suffixes=('_pred', '_annot'))
+    pairs = pairs.rename(columns={
+        f'{column}_pred': 'prediction', f'{column}_annot': 'annotation'})
+    return pairs.sort_values(
+        ['pmcid', 'cand_ix', 'ref_ix'], kind='stable').reset_index(drop=True)
+
+
+def match(annotations, predictions, pair_scores, method='greedy',
+          column='diagnosis'):
+    """ Match predicted to annotated groups of each pmcid
+
+    Args:
+        annotations: annotated groups, with pmcid and `column`
+        predictions: predicted groups, with pmcid and `column`
+        pair_scores: {(prediction, annotation): (p, r, f1)} of the values
+        method: 'greedy' or 'optimal'
+        column: column holding the compared values
+    Returns:
+        list of {'pmcid', 'prediction', 'annotation', 'p', 'r', 'f1'}
+        records, one per matched pair (scores NaN if a value is missing)
+    """
+    assign = ASSIGNMENTS[method]
+    pairs = pair_frame(annotations, predictions, column)
+    if pairs.empty:
+        return []
+
+    missing = (pairs.prediction.isna() | pairs.annotation.isna()).to_numpy()
+    scores = np.full((len(pairs), 3), np.nan)
+    keys = zip(pairs.prediction.to_numpy(), pairs.annotation.to_numpy())
+    for i, key in enumerate(keys):
+        if not missing[i]:
+            scores[i] = pair_scores[key]
+    f1 = np.where(missing, MISSING_SCORE, scores[:, 2])
+
+    pmcids = pairs.pmcid.to_numpy()
+    n_refs = pairs.ref_ix.to_numpy()
+    predicted = pairs.prediction.to_numpy()
+    annotated = pairs.annotation.to_numpy()
+
+    # Pairs are sorted by pmcid, then cand_ix and ref_ix, so each pmcid is a
+    # contiguous block that reshapes into its score matrix
+    _, starts = np.unique(pmcids, return_index=True)
+    ends = np.append(starts[1:], len(pairs))
+
+    all_scores = []
+    for start, end in zip(starts, ends):
+        n_ref = n_refs[start:end].max() + 1
+        matrix = f1[start:end].reshape(-1, n_ref)
+        rows, cols = assign(matrix)
+        for ix in start + rows * n_ref + cols:
+            # Pairs with a missing value keep NaN scores
+            p, r, f = scores[ix]
+            all_scores.append({
+                'pmcid': pmcids[ix],
+                'prediction': predicted[ix],
+                'annotation': annotated[ix],
+                'p': p,
+                'r': r,
+                'f1': f,
+            })
+    return all_scores
@@ -0,0 +1,68 @@
+""" Token-budgeted multi-chunk packing per extraction call
+
+Instead of one call per retrieved chunk, the top-ranked chunks of each
+article are packed into a single prompt, up to a token budget.
+"""
+import numpy as np
+import tiktoken
+
+CHUNK_SEPARATOR = '\n\n[...]\n\n'
+
+
+def get_encoding(model):
+    """ tiktoken encoding for model, cl100k_base for non-OpenAI models """
+    try:
+        return tiktoken.encoding_for_model(model.split('/')[-1])
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(texts, encoding, num_threads=8):
+    return np.array(
+        [len(t) for t in encoding.encode_batch(
+            list(texts), num_threads=num_threads, disallowed_special=())],
+        dtype=np.int64)
+
+
+def pack_chunks(ranked, token_budget, model, separator=CHUNK_SEPARATOR):
+    """ Pack each article's top-ranked chunks into one text.
+
+    Chunks are taken in rank order while the running token count (including
+    separators) fits the budget; the best chunk is always kept. Selected
+    chunks are joined in document order.
+
+    Args:
+        ranked: chunks with pmcid, rank, content, start_char and end_char
+            (e.g. top_k_chunks with k > 1)
+        token_budget: maximum tokens of packed text per article
+        model: extraction model, to pick the tokenizer
+    Returns:
+        one row per pmcid with the packed `content`, `n_tokens`, the
+        `chunks` it contains (rank, start_char, end_char), and the span of
+        those chunks as start_char/end_char
+    """
+    encoding = get_encoding(model)
+    ranked = ranked.sort_values(['pmcid', 'rank'], kind='stable')
+    ranked = ranked.reset_index(drop=True)
+    separator_tokens = len(encoding.encode(separator, disallowed_special=()))
+    ranked['n_tokens'] = count_tokens(ranked['content'], encoding) \
+        + separator_tokens
+
+    total = ranked.groupby('pmcid', sort=False)['n_tokens'].cumsum()
+    first = ~ranked['pmcid'].duplicated()
+    selected = ranked[(total <= token_budget) | first]
+
+    # Restore document order within each article
+    selected = selected.sort_values(['pmcid', 'start_char'], kind='stable')
+
+    grouped = selected.groupby('pmcid', sort=False)
+    packed = grouped.agg(
+        content=('content', separator.join),
+        n_tokens=('n_tokens', 'sum'),
+        start_char=('start_char', 'min'),
+        end_char=('end_char', 'max'),
+    )
+    packed['chunks'] = grouped[['rank', 'start_char', 'end_char']].apply(
+        lambda df: df.to_dict(orient='records'))
+    packed['rank'] = 0
+    return packed.reset_index()
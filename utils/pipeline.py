@@ -0,0 +1,209 @@
+""" Small incremental DAG runner for post-processing stages
+
+Stages declare their input and output paths, the code files they depend on
+and their parameters. A stage's fingerprint hashes the content of all of
+these; a stage re-runs only if an output is missing or its fingerprint
+changed since its last successful run. Dependencies are inferred from
+paths (a stage depends on the stages producing its inputs), and stages
+whose dependencies are done run in parallel.
+"""
+import hashlib
+import json
+import logging
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait)
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """ One step of the pipeline, called as func(*inputs, *outputs, **params)
+
+    Args:
+        name: unique stage name
+        func: picklable (module-level) function
+        inputs: input paths (files or directories)
+        outputs: output paths
+        code: source files the stage depends on (e.g. the module of func,
+            prompt templates)
+        params: keyword arguments for func, part of the fingerprint
+        resource: optional name of a resource the stage holds while running
+            (e.g. 'umls' for a large in-memory index), limited through
+            Pipeline.run(limits=...)
+    """
+
+    def __init__(self, name, func, inputs, outputs, code=(), params=None,
+                 resource=None):
+        self.name = name
+        self.func = func
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+        self.code = [Path(p) for p in code]
+        self.params = params or {}
+        self.resource = resource
+
+    def __call__(self):
+        return self.func(*self.inputs, *self.outputs, **self.params)
+
+    def __repr__(self):
+        return f"Stage({self.name})"
+
+
+class _Hasher:
+    """ Content hashes, reused while a file's size and mtime are unchanged """
+
+    def __init__(self, cache=None):
+        self.cache = cache or {}
+
+    def file(self, path):
+        stat = path.stat()
+        key = str(path)
+        cached = self.cache.get(key)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime]:
+            return cached[2]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        self.cache[key] = [stat.st_size, stat.st_mtime, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def path(self, path):
+        if path.is_dir():
+            sha = hashlib.sha1()
+            for child in sorted(p for p in path.rglob('*') if p.is_file()):
+                sha.update(str(child.relative_to(path)).encode())
+                sha.update(self.file(child).encode())
+            return sha.hexdigest()
+        return self.file(path) if path.exists() else None
+
+    def stage(self, stage):
+        payload = {
+            'inputs': {str(p): self.path(p) for p in stage.inputs},
+            'code': {str(p): self.path(p) for p in stage.code},
+            'params': stage.params,
+        }
+        payload = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class Pipeline:
+    """ Runs stages in dependency order, skipping up-to-date ones
+
+    Args:
+        state_path: JSON file recording fingerprints of completed stages
+    """
+
+    def __init__(self, state_path):
+        self.state_path = Path(state_path)
+        self.stages = {}
+        state = {}
+        if self.state_path.exists():
+            state = json.loads(self.state_path.read_text())
+        self.fingerprints = state.get('fingerprints', {})
+        self.hasher = _Hasher(state.get('hashes'))
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage {stage.name}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def dependencies(self):
+        """ {stage name: names of stages producing its inputs} """
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                producers[output] = stage.name
+        return {
+            name: {producers[p] for p in stage.inputs if p in producers}
+            for name, stage in self.stages.items()
+        }
+
+    def is_stale(self, stage):
+        if any(not p.exists() for p in stage.outputs):
+            return True
+        return self.fingerprints.get(stage.name) != self.hasher.stage(stage)
+
+    def _save(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.state_path.write_text(json.dumps({
+            'fingerprints': self.fingerprints,
+            'hashes': self.hasher.cache,
+        }))
+
+    def run(self, max_workers=4, processes=True, force=False, dry_run=False,
+            limits=None):
+        """ Run stale stages, in parallel once their dependencies are done
+
+        Args:
+            max_workers: stages running at once
+            processes: run stages in worker processes (else threads)
+            force: run all stages
+            dry_run: only report stale stages (assuming upstream re-runs
+                make their dependents stale)
+            limits: {resource: stages holding it at once}, e.g. {'umls': 1}
+        Returns:
+            dict of stage name -> 'ran', 'fresh', 'failed' or 'skipped'
+        """
+        dependencies = self.dependencies()
+        pending = dict(dependencies)
+        status = {}
+        limits = limits or {}
+
+        def blocked(stage):
+            if stage.resource not in limits:
+                return False
+            holding = sum(self.stages[n].resource == stage.resource
+                          for n in running.values())
+            return holding >= limits[stage.resource]
+
+        def ready():
+            return [name for name, deps in pending.items()
+                    if all(d in status for d in deps)]
+
+        executor_cls = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_cls(max_workers) as executor:
+            running = {}
+            while pending or running:
+                for name in ready():
+                    stage = self.stages[name]
+                    deps = dependencies[name]
+                    if any(status[d] in ('failed', 'skipped') for d in deps):
+                        status[name] = 'skipped'
+                    elif dry_run:
+                        upstream = any(status[d] == 'ran' for d in deps)
+                        stale = force or upstream or self.is_stale(stage)
+                        status[name] = 'ran' if stale else 'fresh'
+                    elif force or self.is_stale(stage):
+                        if blocked(stage):
+                            # Waits for a stage holding the resource
+                            continue
+                        logger.info(f"Running {name}")
+                        running[executor.submit(stage)] = name
+                    else:
+                        status[name] = 'fresh'
+                    del pending[name]
+
+                if not running:
+                    if pending and not ready():
+                        raise ValueError(
+                            f"Dependency cycle among {sorted(pending)}")
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Stage {name} failed: {e}")
+                        status[name] = 'failed'
+                        continue
+                    status[name] = 'ran'
+                    self.fingerprints[name] = self.hasher.stage(
+                        self.stages[name])
+                    self._save()
+
+        return status
@@ -0,0 +1,235 @@
+""" Partitioned parquet store of cleaned predictions across runs
+
+All runs live in one hive-partitioned dataset, with run metadata (stage,
+strategy, source, task, model, min_chars, max_chars) as partition columns
+instead of filename underscores, e.g.
+
+    stage=clean/strategy=chunked/source=md/task=demographics-zeroshot/
+        model=gpt-4o-2024-05-13/min_chars=40/max_chars=4000/part-0.parquet
+
+Column types come from the pydantic group models, so readers can load only
+the columns and partitions they need.
+"""
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from nipub_templates.demographics.clean import (
+    META_KEYS, coerce_array, group_schema)
+from nipub_templates.demographics.schemas import (
+    GroupAssesmentType, GroupImaging)
+
+PARTITION_SCHEMA = pa.schema([
+    ('stage', pa.string()),
+    ('strategy', pa.string()),
+    ('source', pa.string()),
+    ('task', pa.string()),
+    ('model', pa.string()),
+    # Strings, as in run names: chunk sizes are not always numeric (maxc-body)
+    ('min_chars', pa.string()),
+    ('max_chars', pa.string()),
+])
+PARTITION_COLUMNS = PARTITION_SCHEMA.names
+CHUNK_COLUMNS = ['min_chars', 'max_chars']
+
+# Post-processing stages, as filename suffixes
+STAGES = ['clean', 'noabbrev', 'umls']
+
+# Text source of strategies that do not name it
+DEFAULT_SOURCES = {'chunked': 'md', 'metaabstracts': 'abstracts'}
+
+# Low-cardinality string columns, stored dictionary encoded
+CATEGORICAL_COLUMNS = [
+    'group_name', 'diagnosis', 'imaging_sample', 'assesment_type',
+    'umls_cui', 'umls_name']
+
+# Columns of UMLS linking output (see utils.umls.link_predictions)
+UMLS_TYPES = {
+    'umls_cui': pa.string(),
+    'umls_name': pa.string(),
+    'umls_prob': pa.float64(),
+    'group_ix': pa.int64(),
+}
+
+
+def column_types(group_models=(GroupImaging, GroupAssesmentType)):
+    """ Arrow type of each known column, from the pydantic group models.
+
+    Integer fields are stored as float64: outputs have fractional values in
+    int fields (e.g. a median age of 34.5), which the store keeps.
+    """
+    types = {}
+    for model in group_models:
+        for field in group_schema(model, META_KEYS):
+            if field.name not in types:
+                types[field.name] = field.type
+    types.update(UMLS_TYPES)
+    for name, type in types.items():
+        if pa.types.is_integer(type) and name not in META_KEYS + ['group_ix']:
+            types[name] = pa.float64()
+        elif name in CATEGORICAL_COLUMNS:
+            types[name] = pa.dictionary(pa.int32(), pa.string())
+    return types
+
+
+def parse_run_name(stem):
+    """ Run metadata from an output file name, e.g.
+    chunked_demographics-zeroshot_gpt-4o-2024-05-13_minc-40_maxc-4000_clean
+    """
+    parts = stem.split('_')
+    run = dict.fromkeys(PARTITION_COLUMNS)
+    run['strategy'] = parts.pop(0)
+    run['stage'] = parts.pop() if parts[-1] in STAGES else 'raw'
+    if run['strategy'] == 'full':
+        run['source'] = parts.pop(0)
+    else:
+        run['source'] = DEFAULT_SOURCES.get(run['strategy'])
+
+    rest, variant = [], []
+    for part in parts:
+        match = re.fullmatch(r'(minc|maxc)-(\w+)', part)
+        if match:
+            key = 'min_chars' if match.group(1) == 'minc' else 'max_chars'
+            run[key] = match.group(2)
+        elif run['min_chars'] is None:
+            rest.append(part)
+        else:
+            variant.append(part)
+    run['model'] = rest.pop()
+    # Parts after the chunk sizes (e.g. _json) are a variant of the task, so
+    # distinct runs don't share a partition
+    run['task'] = '_'.join(rest + variant)
+    return run
+
+
+def to_table(predictions, types=None):
+    """ Typed Arrow table of a predictions DataFrame.
+
+    Column names are normalized (spaces to underscores), known columns are
+    coerced to their type (invalid values become null), and unknown columns
+    are kept with their inferred type.
+    """
+    types = types or column_types()
+    predictions = predictions.copy()
+    predictions.columns = predictions.columns.str.replace(' ', '_')
+    predictions = predictions.loc[:, ~predictions.columns.duplicated()]
+
+    arrays, fields = [], []
+    for name in predictions.columns:
+        if name in PARTITION_COLUMNS:
+            continue
+        if name in types:
+            array = coerce_array(predictions[name].to_list(), types[name])
+        else:
+            array = pa.array(predictions[name], from_pandas=True)
+        arrays.append(array)
+        fields.append(pa.field(name, array.type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def _chunk_size(value):
+    """ Partition value of min_chars / max_chars (e.g. 4000 -> '4000') """
+    return None if value is None else str(value)
+
+
+class PredictionStore:
+    """ Hive-partitioned parquet dataset of predictions, one partition per
+    run and stage
+
+    Args:
+        root: dataset directory
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+
+    def write(self, predictions, stage, strategy, task, model, source=None,
+              min_chars=None, max_chars=None):
+        """ Write (or replace) the predictions of one run and stage """
+        run = dict(stage=stage, strategy=strategy, source=source, task=task,
+                   model=model, min_chars=_chunk_size(min_chars),
+                   max_chars=_chunk_size(max_chars))
+        table = predictions if isinstance(predictions, pa.Table) \
+            else to_table(predictions)
+        for name, type in zip(PARTITION_SCHEMA.names, PARTITION_SCHEMA.types):
+            table = table.append_column(
+                pa.field(name, type),
+                pa.array([run[name]] * table.num_rows, type=type))
+
+        ds.write_dataset(
+            table, self.root, format='parquet',
+            partitioning=self.partitioning,
+            basename_template='part-{i}.parquet',
+            existing_data_behavior='delete_matching',
+        )
+
+    def partition_path(self, **run):
+        """ Directory holding the predictions of one run and stage """
+        path = self.root
+        for name in PARTITION_COLUMNS:
+            value = run.get(name)
+            value = '__HIVE_DEFAULT_PARTITION__' if value is None \
+                else quote(str(value), safe='')
+            path = path / f'{name}={value}'
+        return path
+
+    def dataset(self):
+        """ Dataset over all runs, with a schema unified across runs """
+        dataset = ds.dataset(
+            self.root, format='parquet', partitioning=self.partitioning)
+        # Runs have different columns (e.g. UMLS stage, extra fields)
+        schemas = [fragment.physical_schema
+                   for fragment in dataset.get_fragments()]
+        schema = pa.unify_schemas(
+            schemas + [PARTITION_SCHEMA], promote_options='permissive')
+        return ds.dataset(
+            self.root, format='parquet', schema=schema,
+            partitioning=self.partitioning)
+
+    def read(self, columns=None, categorical=True, **filters):
+        """ Read predictions, optionally a subset of columns and runs.
+
+        Args:
+            columns: columns to read (default: all)
+            categorical: return dictionary columns as pandas categoricals
+            filters: partition values, e.g. stage='clean',
+                strategy='chunked', or a list of accepted values
+        Returns:
+            DataFrame
+        """
+        expression = None
+        for name, value in filters.items():
+            if name in CHUNK_COLUMNS:
+                value = [_chunk_size(v) for v in value] \
+                    if isinstance(value, (list, tuple, set)) \
+                    else _chunk_size(value)
+            if isinstance(value, (list, tuple, set)):
+                condition = ds.field(name).isin(list(value))
+            elif value is None:
+                condition = ds.field(name).is_null()
+            else:
+                condition = ds.field(name) == value
+            expression = condition if expression is None \
+                else expression & condition
+
+        table = self.dataset().to_table(columns=columns, filter=expression)
+        predictions = table.to_pandas()
+        if categorical:
+            for name in set(PARTITION_COLUMNS) & set(predictions.columns):
+                if pd.api.types.is_string_dtype(predictions[name]):
+                    predictions[name] = predictions[name].astype('category')
+        else:
+            for name, dtype in predictions.dtypes.items():
+                if isinstance(dtype, pd.CategoricalDtype):
+                    predictions[name] = predictions[name].astype(object)
+        return predictions
+
+    def runs(self):
+        """ One row per stored run and stage """
+        return self.read(columns=PARTITION_COLUMNS, categorical=False) \
+            .drop_duplicates().reset_index(drop=True)
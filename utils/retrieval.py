@@ -0,0 +1,105 @@
+""" Vectorized corpus-wide top-k chunk retrieval """
+import numpy as np
+import pandas as pd
+
+from .async_extract import extract_to_jsonl
+from .embedding_store import chunk_articles, embed_texts
+from .packing import pack_chunks
+
+# Chunk metadata kept with each prediction
+CHUNK_META = ['rank', 'start_char', 'end_char']
+
+
+def _cosine_scores(vectors, rows, query, block_size):
+    """ Cosine similarity of vectors[rows] to query, computed in blocks """
+    query = np.asarray(query, dtype=np.float32)
+    query = query / np.linalg.norm(query)
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block = np.asarray(vectors[rows[start:start + block_size]])
+        norms = np.linalg.norm(block, axis=1)
+        norms[norms == 0] = 1
+        scores[start:start + block_size] = block @ query / norms
+    return scores
+
+
+def top_k_chunks(chunks, vectors, query, k=1, rows=None, block_size=500_000):
+    """ Top-k chunks per pmcid for a query, over the whole corpus at once.
+
+    Args:
+        chunks: DataFrame of chunks, with a 'pmcid' column
+        vectors: (n, dim) embedding matrix (e.g. EmbeddingStore.vectors)
+        query: (dim,) query embedding
+        k: number of chunks to keep per pmcid
+        rows: row of each chunk in `vectors` (default: chunks.row, or
+            the chunk's position)
+        block_size: number of chunks scored per matrix multiply
+    Returns:
+        the top-k chunks of each pmcid, with 'rank' (0 is best) and 'score'
+    """
+    if rows is None:
+        rows = chunks['row'] if 'row' in chunks else np.arange(len(chunks))
+    rows = np.asarray(rows)
+
+    scores = _cosine_scores(vectors, rows, query, block_size)
+    codes, _ = pd.factorize(chunks['pmcid'])
+
+    # Sort by pmcid, then by descending score within pmcid
+    order = np.lexsort((-scores, codes))
+    sorted_codes = codes[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes)
+
+    keep = order[rank < k]
+    results = chunks.iloc[keep].copy()
+    results['rank'] = rank[rank < k]
+    results['score'] = scores[keep]
+    return results.reset_index(drop=True)
+
+
+def retrieve_chunks(articles, min_chars, max_chars, store, embed_client,
+                    embed_model, search_query, k=1):
+    """ Chunk and embed articles, and return the top-k chunks of each """
+    chunks = chunk_articles(articles, min_chars, max_chars)
+    chunks['row'] = embed_texts(
+        chunks['content'].to_list(), store, embed_client, embed_model)
+    query_row = embed_texts([search_query], store, embed_client, embed_model)
+
+    return top_k_chunks(
+        chunks, store.vectors, store.vectors[query_row[0]], k=k)
+
+
+def search_extract(articles, output_path, min_chars, max_chars, store,
+                   embed_client, embed_model, extraction_model,
+                   extraction_client, search_query, messages, output_schema,
+                   k=1, token_budget=None, **kwargs):
+    """ Retrieve the top chunks of each article and extract from them.
+
+    In-repo replacement for publang's search_extract: chunks are embedded
+    through the shared EmbeddingStore, retrieval is one vectorized pass over
+    the corpus, and predictions are streamed to a resumable JSONL file.
+
+    Args:
+        articles: list of dicts with 'pmcid' and 'text'
+        output_path: JSONL file for predictions
+        store: EmbeddingStore for embed_model
+        k: chunks retrieved per article. Without a token budget, each chunk
+            is a separate call (resume is by pmcid, so use k=1).
+        token_budget: if set, pack each article's top-k chunks into one
+            prompt of at most this many tokens (see pack_chunks)
+        kwargs: extra arguments for the extraction engine (cache, ...)
+    """
+    top = retrieve_chunks(
+        articles, min_chars, max_chars, store, embed_client, embed_model,
+        search_query, k=k)
+
+    meta_cols = CHUNK_META
+    if token_budget is not None:
+        top = pack_chunks(top, token_budget, extraction_model)
+        meta_cols = CHUNK_META + ['chunks']
+
+    extract_to_jsonl(
+        top['content'].to_list(), top['pmcid'].to_list(), output_path,
+        id_key='pmcid', meta=top[meta_cols].to_dict(orient='records'),
+        model=extraction_model, client=extraction_client,
+        messages=messages, output_schema=output_schema, **kwargs
+    )
@@ -0,0 +1,174 @@
+""" Batched and memoized UMLS candidate generation
+
+Unique normalized mentions are sent to scispacy's CandidateGenerator in
+batches, and raw candidates are kept in a persistent mention -> candidates
+cache, so identical diagnoses are only linked once across all files.
+Filtering and the join back to predictions are vectorized.
+"""
+import json
+import re
+import sqlite3
+
+import pandas as pd
+
+CANDIDATE_COLUMNS = [
+    'mention', 'umls_cui', 'umls_name', 'umls_prob', 'has_definition']
+
+
+def normalize_mention(text):
+    """ Key used for candidate lookup (the generator's TF-IDF lowercases) """
+    return re.sub(r'\s+', ' ', str(text)).strip().lower()
+
+
+class CandidateCache:
+    """ Persistent raw candidates of each (mention, k), per knowledge base
+
+    Args:
+        path: path to the SQLite file
+        kb: name of the knowledge base the candidates come from
+    """
+
+    def __init__(self, path, kb='umls'):
+        self.kb = kb
+        self._conn = sqlite3.connect(str(path), timeout=60)
+        # Shared by concurrent pipeline stages
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS candidates ("
+            "kb TEXT, mention TEXT, k INTEGER, value TEXT, "
+            "PRIMARY KEY (kb, mention, k))"
+        )
+
+    def get_many(self, mentions, k):
+        found = {}
+        for i in range(0, len(mentions), 500):
+            chunk = mentions[i:i + 500]
+            rows = self._conn.execute(
+                "SELECT mention, value FROM candidates WHERE kb = ? AND k = ? "
+                f"AND mention IN ({','.join('?' * len(chunk))})",
+                [self.kb, k, *chunk])
+            for mention, value in rows:
+                found[mention] = json.loads(value)
+        return found
+
+    def set_many(self, candidates, k):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO candidates VALUES (?, ?, ?, ?)",
+                [(self.kb, m, k, json.dumps(c)) for m, c in candidates.items()])
+
+    def close(self):
+        self._conn.close()
+
+
+def raw_candidates(generator, mentions, k):
+    """ [cui, name, best similarity, has_definition] candidates of each
+    mention, from one batched CandidateGenerator call """
+    results = []
+    for candidates in generator(list(mentions), k):
+        records = []
+        for cand in candidates:
+            name = cand.canonical_name if hasattr(cand, 'canonical_name') \
+                else cand.aliases[0]
+            definition = generator.kb.cui_to_entity[cand.concept_id].definition
+            records.append([
+                cand.concept_id, name, float(max(cand.similarities)),
+                definition is not None,
+            ])
+        results.append(records)
+    return results
+
+
+class LazyGenerator:
+    """ Candidate generator loaded on first use, so runs whose mentions are
+    all cached never load the (multi-GB) index
+
+    Args:
+        load: function returning a CandidateGenerator or a LinkerClient
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._generator = None
+
+    def raw_candidates(self, mentions, k):
+        if self._generator is None:
+            self._generator = self._load()
+        generate = getattr(self._generator, 'raw_candidates', None)
+        if generate is None:
+            return raw_candidates(self._generator, mentions, k)
+        return generate(mentions, k)
+
+
+def generate_candidates(mentions, generator, cache=None, k=30,
+                        batch_size=256):
+    """ Raw top-k candidates of unique normalized mentions.
+
+    Args:
+        mentions: iterable of mention strings
+        generator: scispacy CandidateGenerator, or any object with a
+            raw_candidates(mentions, k) method (e.g. a LinkerClient)
+        cache: optional CandidateCache; only unseen mentions are generated
+        k: candidates per mention
+        batch_size: mentions per generator call
+    Returns:
+        DataFrame with CANDIDATE_COLUMNS, one row per (mention, candidate)
+    """
+    mentions = list(dict.fromkeys(normalize_mention(m) for m in mentions))
+    found = cache.get_many(mentions, k) if cache is not None else {}
+    missing = [m for m in mentions if m not in found]
+
+    generate = getattr(generator, 'raw_candidates', None)
+    if generate is None:
+        generate = lambda batch, k: raw_candidates(generator, batch, k)
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        generated = dict(zip(batch, generate(batch, k)))
+        if cache is not None:
+            cache.set_many(generated, k)
+        found.update(generated)
+
+    records = [[mention, *cand] for mention in mentions
+               for cand in found[mention]]
+    return pd.DataFrame.from_records(records, columns=CANDIDATE_COLUMNS)
+
+
+def filter_candidates(candidates, threshold=0.5, no_definition_threshold=0.95,
+                      filter_for_definitions=True, max_entities_per_mention=5):
+    """ Keep confident candidates, best first, at most
+    max_entities_per_mention per mention """
+    keep = candidates['umls_prob'] > threshold
+    if filter_for_definitions:
+        keep &= candidates['has_definition'] \
+            | (candidates['umls_prob'] >= no_definition_threshold)
+    candidates = candidates[keep].sort_values(
+        ['mention', 'umls_prob'], ascending=[True, False], kind='stable')
+    candidates = candidates.groupby('mention').head(max_entities_per_mention)
+    return candidates.drop(columns='has_definition')
+
+
+def link_predictions(predictions, candidates, column='diagnosis'):
+    """ Join filtered candidates back to patient group predictions
+
+    Returns:
+        one row per (group, candidate), with pmcid, the original mention,
+        umls_cui, umls_name, umls_prob, count, group_ix, start_char and
+        end_char
+    """
+    patients = predictions[
+        (predictions['group_name'] == 'patients')
+        & predictions[column].notna()]
+    patients = patients.assign(
+        group_ix=patients.index,
+        mention=patients[column].map(normalize_mention))
+    for col in ('start_char', 'end_char'):
+        if col not in patients:
+            patients[col] = None
+
+    linked = patients.sort_values(['pmcid', 'group_ix'], kind='stable').merge(
+        candidates, on='mention', how='inner', sort=False)
+    linked['pmcid'] = linked['pmcid'].astype(int)
+    return linked[[
+        'pmcid', column, 'umls_cui', 'umls_name', 'umls_prob', 'count',
+        'group_ix', 'start_char', 'end_char']]
@@ -0,0 +1,166 @@
+""" Long-lived local UMLS linker service
+
+Loading CandidateGenerator (TF-IDF vectorizer, ANN index and the
+cui_to_entity map) takes minutes and several GB. The service loads it once
+and serves batched candidate requests over localhost HTTP, so scripts,
+notebooks and workers share a single copy of the KB.
+
+Endpoints (JSON):
+    GET  /health      -> {"status": "ok", "kb": name}
+    POST /raw         {"mentions": [...], "k": 30}
+                      -> {"candidates": [[[cui, name, prob, has_definition],
+                                          ...], ...]}
+    POST /candidates  {"mentions": [...], "k": 30, **filter_kwargs}
+                      -> {"candidates": [{mention, umls_cui, umls_name,
+                                          umls_prob}, ...]}
+"""
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import requests
+
+from .umls import (
+    CANDIDATE_COLUMNS, filter_candidates, generate_candidates,
+    raw_candidates)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+# Filtering arguments accepted by /candidates (see filter_candidates)
+_FILTER_KWARGS = (
+    'threshold', 'no_definition_threshold', 'filter_for_definitions',
+    'max_entities_per_mention')
+
+
+class LinkerHandler(BaseHTTPRequestHandler):
+    """ Request handler; the linker is set on the server instance """
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok', 'kb': self.server.kb_name})
+        else:
+            self._send(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            mentions = [str(m) for m in request['mentions']]
+            k = int(request.get('k', 30))
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': f'Invalid request: {e}'})
+            return
+
+        if self.path == '/raw':
+            candidates = self.server.raw_candidates(mentions, k)
+            self._send(200, {'candidates': candidates})
+        elif self.path == '/candidates':
+            kwargs = {key: request[key] for key in _FILTER_KWARGS
+                      if key in request}
+            candidates = filter_candidates(
+                generate_candidates(mentions, self.server, k=k), **kwargs)
+            self._send(200, {
+                'candidates': candidates.to_dict(orient='records')})
+        else:
+            self._send(404, {'error': f'Unknown path {self.path}'})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class LinkerServer(ThreadingHTTPServer):
+    """ HTTP server holding one CandidateGenerator.
+
+    Connections are handled in threads; generator calls are serialized, as
+    the ANN index parallelizes each batched query itself.
+
+    Args:
+        address: (host, port)
+        generator: scispacy CandidateGenerator
+        kb_name: name reported by /health
+    """
+    daemon_threads = True
+
+    def __init__(self, address, generator, kb_name='umls'):
+        super().__init__(address, LinkerHandler)
+        self.generator = generator
+        self.kb_name = kb_name
+        self._lock = threading.Lock()
+
+    def raw_candidates(self, mentions, k):
+        with self._lock:
+            return raw_candidates(self.generator, mentions, k)
+
+
+def serve(host='127.0.0.1', port=8765, name='umls'):
+    """ Load the candidate generator once and serve it until interrupted """
+    from scispacy.candidate_generation import CandidateGenerator
+
+    logger.info(f"Loading {name} candidate generator")
+    server = LinkerServer((host, port), CandidateGenerator(name=name), name)
+    logger.info(f"Serving {name} linker on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class LinkerClient:
+    """ Client for a running linker service.
+
+    Can be passed to generate_candidates in place of a CandidateGenerator.
+
+    Args:
+        url: base url of the service
+        batch_size: mentions per request
+        timeout: seconds per request
+    """
+
+    def __init__(self, url=DEFAULT_URL, batch_size=1000, timeout=600):
+        self.url = url.rstrip('/')
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def available(self):
+        try:
+            response = self.session.get(f'{self.url}/health', timeout=5)
+            return response.ok
+        except requests.ConnectionError:
+            return False
+
+    def _post(self, path, payload):
+        response = self.session.post(
+            f'{self.url}{path}', json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['candidates']
+
+    def raw_candidates(self, mentions, k):
+        """ Raw candidate records of each mention, as in umls.raw_candidates """
+        results = []
+        for start in range(0, len(mentions), self.batch_size):
+            batch = list(mentions[start:start + self.batch_size])
+            results.extend(self._post('/raw', {'mentions': batch, 'k': k}))
+        return results
+
+    def get_candidates(self, mentions, k=30, **filter_kwargs):
+        """ Filtered candidates of mentions, as a DataFrame """
+        records = []
+        for start in range(0, len(mentions), self.batch_size):
+            batch = list(mentions[start:start + self.batch_size])
+            records.extend(self._post(
+                '/candidates', {'mentions': batch, 'k': k, **filter_kwargs}))
+        return pd.DataFrame.from_records(
+            records, columns=CANDIDATE_COLUMNS[:-1])
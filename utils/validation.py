@@ -0,0 +1,316 @@
+""" Compiled validation and repair of extraction responses
+
+Each output_schema (JSON schema, as produced by pydantic) is compiled once
+into nested closures that validate a response and apply cheap,
+deterministic repairs:
+
+- "null", "none", "n/a" and empty strings become null
+- numeric strings are coerced to integers / numbers
+- scalars are coerced to strings
+- enum values are normalized (case, whitespace, singular/plural,
+  true/false -> yes/no)
+- JSON-encoded arrays and objects are decoded; a lone object where an
+  array is expected is wrapped
+- scalar values that cannot be coerced (or do not match an enum) become
+  null; missing nested properties are left to clean_predictions
+
+A response is unrecoverable (and worth a retry) only if the top-level
+structure is wrong, e.g. it is not an object, or a required, non-nullable
+property such as `groups` is missing or unusable.
+"""
+import json
+import re
+from collections import Counter
+from functools import lru_cache
+
+_NULL_STRINGS = {'', 'null', 'none', 'n/a', 'na', 'nan', 'not reported',
+                 'unknown'}
+_BOOL_STRINGS = {'true': True, 'yes': True, 'false': False, 'no': False}
+# Numbers with thousands separators, e.g. "1,024"; "24,5" is not one
+_THOUSANDS = re.compile(r'^\d{1,3}(,\d{3})+(\.\d+)?$')
+
+
+class SchemaError(ValueError):
+    """ Response cannot be repaired to match the schema """
+
+
+class _Repair:
+    """ Marks that a value was changed; threaded through the closures """
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+
+def _parse_number(value):
+    """ Float of a numeric string, or None (e.g. for a decimal comma) """
+    text = str(value).strip()
+    if _THOUSANDS.match(text):
+        text = text.replace(',', '')
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _is_null(value):
+    return value is None or (
+        isinstance(value, str) and value.strip().lower() in _NULL_STRINGS)
+
+
+def _compile_integer(schema):
+    def check(value, repair, path):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, float) and value.is_integer():
+            repair.count += 1
+            return int(value)
+        if isinstance(value, float):
+            # Fractional values (e.g. a median age) are kept
+            return value
+        repair.count += 1
+        number = _parse_number(value)
+        if number is None:
+            return None
+        return int(number) if number.is_integer() else number
+    return check
+
+
+def _compile_number(schema):
+    def check(value, repair, path):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        repair.count += 1
+        return _parse_number(value)
+    return check
+
+
+def _compile_boolean(schema):
+    def check(value, repair, path):
+        if isinstance(value, bool):
+            return value
+        repair.count += 1
+        return _BOOL_STRINGS.get(str(value).strip().lower())
+    return check
+
+
+def _compile_enum(schema):
+    allowed = list(schema['enum'])
+    normalized = {}
+    for label in allowed:
+        key = str(label).strip().lower()
+        normalized.setdefault(key, label)
+        # Singular / plural forms, e.g. "patient" -> "patients"
+        if len(key) > 3:
+            normalized.setdefault(
+                key[:-1] if key.endswith('s') else key + 's', label)
+    # Booleans for yes/no enums (e.g. imaging_sample: true -> "yes")
+    for truth, label in ((True, 'yes'), (False, 'no')):
+        if label in normalized:
+            normalized[str(truth).lower()] = normalized[label]
+
+    def check(value, repair, path):
+        if value in allowed:
+            return value
+        repair.count += 1
+        # Anything else (e.g. "not specified") is not guessed
+        return normalized.get(str(value).strip().lower())
+    return check
+
+
+def _compile_string(schema):
+    def check(value, repair, path):
+        if isinstance(value, str):
+            return value
+        repair.count += 1
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        return str(value)
+    return check
+
+
+def _decode_json(value, expected_type):
+    if isinstance(value, str):
+        try:
+            decoded = json.loads(value)
+        except json.JSONDecodeError:
+            return None
+        if isinstance(decoded, expected_type):
+            return decoded
+    return None
+
+
+def _compile_array(schema, defs):
+    check_item = _compile(schema.get('items', {}), defs)
+
+    def check(value, repair, path):
+        if not isinstance(value, list):
+            decoded = _decode_json(value, list)
+            if decoded is None and isinstance(value, dict):
+                decoded = [value]
+            if decoded is None:
+                raise SchemaError(f"{path}: expected an array")
+            repair.count += 1
+            value = decoded
+        items = []
+        for i, item in enumerate(value):
+            item = check_item(item, repair, f'{path}[{i}]')
+            if item is None:
+                repair.count += 1
+                continue
+            items.append(item)
+        return items
+    return check
+
+
+def _compile_object(schema, defs, root=False):
+    properties = {
+        name: _compile(prop, defs)
+        for name, prop in schema.get('properties', {}).items()
+    }
+    # Only enforced at the top level
+    required = [
+        name for name in schema.get('required', []) if not any(
+            s.get('type') == 'null'
+            for s in schema.get('properties', {}).get(name, {}).get('anyOf', []))
+    ] if root else []
+    additional = schema.get('additionalProperties')
+    check_additional = _compile(additional, defs) \
+        if isinstance(additional, dict) else None
+
+    def check(value, repair, path):
+        if not isinstance(value, dict):
+            decoded = _decode_json(value, dict)
+            if decoded is None:
+                raise SchemaError(f"{path}: expected an object")
+            repair.count += 1
+            value = decoded
+
+        result = {}
+        for name, item in value.items():
+            if name in properties:
+                result[name] = properties[name](item, repair, f'{path}.{name}')
+            elif check_additional is not None:
+                result[name] = check_additional(
+                    item, repair, f'{path}.{name}')
+            else:
+                result[name] = item
+
+        for name in required:
+            if result.get(name) is None:
+                raise SchemaError(f"{path}: missing '{name}'")
+        return result
+    return check
+
+
+def _compile(schema, defs, root=False):
+    if '$ref' in schema:
+        schema = defs[schema['$ref'].split('/')[-1]]
+
+    if 'anyOf' in schema:
+        options = [s for s in schema['anyOf'] if s.get('type') != 'null']
+        nullable = len(options) < len(schema['anyOf'])
+        inner = _compile(options[0], defs) if len(options) == 1 else None
+
+        def check_any(value, repair, path):
+            if _is_null(value):
+                return None
+            if inner is None:
+                return value
+            try:
+                return inner(value, repair, path)
+            except SchemaError:
+                if nullable:
+                    repair.count += 1
+                    return None
+                raise
+        return check_any
+
+    if 'enum' in schema:
+        inner = _compile_enum(schema)
+    elif schema.get('type') == 'object':
+        inner = _compile_object(schema, defs, root=root)
+    elif schema.get('type') == 'array':
+        inner = _compile_array(schema, defs)
+    elif schema.get('type') == 'integer':
+        inner = _compile_integer(schema)
+    elif schema.get('type') == 'number':
+        inner = _compile_number(schema)
+    elif schema.get('type') == 'boolean':
+        inner = _compile_boolean(schema)
+    elif schema.get('type') == 'string':
+        inner = _compile_string(schema)
+    else:
+        return lambda value, repair, path: value
+
+    if root:
+        return inner
+
+    def check(value, repair, path):
+        if _is_null(value):
+            if value is not None:
+                repair.count += 1
+            return None
+        return inner(value, repair, path)
+    return check
+
+
+class SchemaValidator:
+    """ Validate and repair responses against a compiled output schema.
+
+    Counters (`stats`): valid (unchanged), repaired, invalid (unrecoverable),
+    retried and failed (still invalid after retries), updated by callers
+    through record_retry / record_failure.
+
+    Args:
+        output_schema: JSON schema of the extraction function
+    """
+
+    def __init__(self, output_schema):
+        self._check = _compiled(json.dumps(output_schema, sort_keys=True))
+        self.stats = Counter()
+
+    def __call__(self, response):
+        """ Repaired response; raises SchemaError if unrecoverable """
+        repair = _Repair()
+        try:
+            result = self._check(response, repair, '$')
+        except SchemaError:
+            self.stats['invalid'] += 1
+            raise
+        self.stats['repaired' if repair.count else 'valid'] += 1
+        return result
+
+    def repair_or_none(self, response):
+        try:
+            return self(response)
+        except SchemaError:
+            return None
+
+    def record_retry(self):
+        self.stats['retried'] += 1
+
+    def record_failure(self):
+        self.stats['failed'] += 1
+
+    def rates(self):
+        """ Repair and retry rates, over all validated responses """
+        total = sum(self.stats[k] for k in ('valid', 'repaired', 'invalid'))
+        return {
+            'validated': total,
+            'repair_rate': self.stats['repaired'] / total if total else 0.0,
+            'invalid_rate': self.stats['invalid'] / total if total else 0.0,
+            'retry_rate': self.stats['retried'] / total if total else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def _compiled(schema_json):
+    schema = json.loads(schema_json)
+    return _compile(schema, schema.get('$defs', {}), root=True)
+
+
+def get_validator(output_schema):
+    """ Validator of an output_schema with its own counters, so each run
+    reports its own rates; the compiled schema is shared across runs """
+    return SchemaValidator(output_schema)